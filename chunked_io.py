@@ -0,0 +1,167 @@
+__all__ = [
+    'IOStats',
+    'ChunkReader',
+    'ChunkWriter',
+    'release_pages',
+    'read_views',
+]
+
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+DEFAULT_CHUNK_ROWS = 1 << 24
+
+
+# Bytes moved and time spent by the background I/O threads, and time the computations spent waiting for them
+class IOStats:
+    def __init__(self):
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+        self.write_bytes = 0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, read_bytes=0, read_seconds=0.0, write_bytes=0, write_seconds=0.0, wait_seconds=0.0):
+        with self._lock:
+            self.read_bytes += read_bytes
+            self.read_seconds += read_seconds
+            self.write_bytes += write_bytes
+            self.write_seconds += write_seconds
+            self.wait_seconds += wait_seconds
+
+    # throughput of the reads and writes (MB/s) and the I/O wait, as records of the timer
+    def report(self, timer, label: str):
+        if self.read_bytes:
+            timer.record(f'{label} read MB/s', self.read_bytes / 1e6 / max(self.read_seconds, 1e-9))
+        if self.write_bytes:
+            timer.record(f'{label} write MB/s', self.write_bytes / 1e6 / max(self.write_seconds, 1e-9))
+        timer.record(f'{label} I/O wait', self.wait_seconds)
+
+
+# Iterates over a binary file in chunks of `chunk_rows` values. The next chunk is read on a background thread
+# while the current one is being processed, so at most two chunks are in memory at a time.
+class ChunkReader:
+    def __init__(self, fn: str, dtype, chunk_rows: int = DEFAULT_CHUNK_ROWS, stats: IOStats = None):
+        self.fn = fn
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.stats = stats or IOStats()
+
+    def _read(self, f):
+        start_t = perf_counter()
+        chunk = np.fromfile(f, dtype=self.dtype, count=self.chunk_rows)
+        self.stats.add(read_bytes=chunk.nbytes, read_seconds=perf_counter() - start_t)
+        return chunk
+
+    def __iter__(self):
+        with open(self.fn, 'rb') as f, ThreadPoolExecutor(1) as executor:
+            next_chunk = executor.submit(self._read, f)
+            while True:
+                start_t = perf_counter()
+                chunk = next_chunk.result()
+                self.stats.add(wait_seconds=perf_counter() - start_t)
+                if len(chunk) == 0:
+                    return
+
+                next_chunk = executor.submit(self._read, f)
+                yield chunk
+
+    # the whole file, read chunk by chunk into a single array, converted to `dtype` chunk by chunk
+    def read_all(self, rows: int, dtype=None):
+        values = np.empty(rows, dtype=dtype or self.dtype)
+        start = 0
+        for chunk in self:
+            values[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        return values
+
+
+# Appends chunks to a binary file. Each chunk is written on a background thread while the next one is being computed;
+# a new chunk waits for the previous one to be flushed, so at most two chunks are in memory at a time.
+# Without `dtype`, the chunks are written in the type of the first one.
+class ChunkWriter:
+    def __init__(self, fn: str, dtype=None, stats: IOStats = None):
+        self.fn = fn
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.stats = stats or IOStats()
+        self.rows = 0
+        self._f = open(fn, 'wb+')
+        self._executor = ThreadPoolExecutor(1)
+        self._pending = None
+
+    def _write(self, chunk):
+        start_t = perf_counter()
+        chunk.tofile(self._f)
+        self.stats.add(write_bytes=chunk.nbytes, write_seconds=perf_counter() - start_t)
+
+    def _wait(self):
+        if self._pending is not None:
+            start_t = perf_counter()
+            self._pending.result()
+            self.stats.add(wait_seconds=perf_counter() - start_t)
+            self._pending = None
+
+    def write(self, values):
+        chunk = np.asarray(values, dtype=self.dtype)
+        self.dtype = chunk.dtype
+        self._wait()
+        self._pending = self._executor.submit(self._write, chunk)
+        self.rows += len(chunk)
+
+    def close(self):
+        try:
+            self._wait()
+        finally:
+            self._executor.shutdown()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Drops the pages of the `rows` (a slice) of a memory-mapped column (see Manifest.view) from the memory of the process,
+# once they have been processed: they stay in the page cache, so reading them again is free, but they no longer count
+# in its resident memory. Without madvise (e.g. on Windows), the pages are left to the OS.
+def release_pages(view, rows: slice):
+    mapped = view.base
+    if not isinstance(mapped, mmap.mmap) or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    start, stop, _ = rows.indices(len(view))
+    begin = start * view.itemsize // mmap.PAGESIZE * mmap.PAGESIZE
+    if stop > start:
+        mapped.madvise(mmap.MADV_DONTNEED, begin, stop * view.itemsize - begin)
+
+
+# Copies of the slices of memory-mapped columns (pairs of a view and `rows`, a slice), in the given order: each one
+# is read on a background thread while the previous one is being processed, and its pages are released once copied
+# (see release_pages), so that, as with ChunkReader, at most two slices are in memory at a time
+def read_views(slices, stats: IOStats = None):
+    stats = stats or IOStats()
+
+    def read(view, rows):
+        start_t = perf_counter()
+        values = np.array(view[rows])
+        release_pages(view, rows)
+        stats.add(read_bytes=values.nbytes, read_seconds=perf_counter() - start_t)
+        return values
+
+    slices = iter(slices)
+    with ThreadPoolExecutor(1) as executor:
+        next_slice = next(slices, None)
+        next_values = executor.submit(read, *next_slice) if next_slice is not None else None
+        while next_values is not None:
+            start_t = perf_counter()
+            values = next_values.result()
+            stats.add(wait_seconds=perf_counter() - start_t)
+
+            next_slice = next(slices, None)
+            next_values = executor.submit(read, *next_slice) if next_slice is not None else None
+            yield values
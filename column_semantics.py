@@ -0,0 +1,76 @@
+__all__ = [
+    'describe_column',
+]
+
+from utils import composite_metrics, diff_metric_rates, rate_cells, ratio_metric_rates
+
+groups = {'i': 'minority', 'j': 'majority'}
+
+
+def _describe_rate(rate: str):
+    a_cells, b_cells = rate_cells[rate]
+    a = '+'.join(a_cells)
+    return f'{rate} = {a}/({a}+{"+".join(b_cells)})'
+
+
+def _describe_group_rate(name: str):
+    group, rate = name.split('_', 1)
+    for part, part_name in [('_num', 'numerator'), ('_den', 'denominator')]:
+        if rate.endswith(part) and rate[:-len(part)] in rate_cells:
+            return f'{part_name} of the {groups[group]} group\'s {_describe_rate(rate[:-len(part)])}'
+    if rate in rate_cells:
+        return f'{groups[group]} group\'s {_describe_rate(rate)}'
+    return None
+
+
+def _describe_metric(name: str):
+    if name in diff_metric_rates:
+        return f'difference metric: majority - minority {diff_metric_rates[name]}'
+    if name in ratio_metric_rates:
+        return f'ratio metric: majority / minority {ratio_metric_rates[name]}'
+    if name in composite_metrics:
+        return f'composite metric: {composite_metrics[name][0].__name__} (see utils.composite_metrics)'
+    return None
+
+
+# What a file of out/calculations holds, recorded with its dtype and length in the manifest;
+# the description follows from the naming conventions of metrics_calculations
+def describe_column(fn: str):
+    name, *suffixes = fn.removesuffix('.bin').split('.')
+    if suffixes[-1:] == ['zones']:
+        column = '.'.join([name, *suffixes[:-1]])
+        return f'zone map (min, max and NaN count of each zone of rows, see zone_maps.py) of {column}'
+    known = {
+        'gr': 'group ratio: majority group size / sample size',
+        'ir': 'imbalance ratio: positives / sample size',
+        'accuracy': 'accuracy of the classifier: (TP + TN) / sample size',
+        'g_mean': 'geometric mean of the TPR and TNR of the classifier',
+        'undefined': 'bitmask of the rates with a zero denominator, see utils.get_undefined_bit',
+        'diff_values': 'sorted values of the difference metrics, decoding the .codes.bin files',
+        'ratio_categories': 'counts of the ratio categories: metric x (gr, ir) x ratio numerator x category',
+    }
+    if name in known and not suffixes:
+        return known[name]
+    if name in ('gr', 'ir') and suffixes == ['key']:
+        return f'integer stratum key, the numerator of the {known[name].split(":")[0]} (see strata.py)'
+
+    description = _describe_metric(name) or (_describe_group_rate(name) if name[:2] in ('i_', 'j_') else None)
+    if description is None:
+        return ''
+    if suffixes == ['codes']:
+        return f'codes into diff_values.bin of the {description}'
+    if suffixes == ['cat']:
+        return f'category (utils.ratio_categories) of the {description}'
+    if suffixes == ['frac']:
+        return f'index a * (sample size + 1) + b of the {description}'
+    if suffixes == ['index', 'runs', 'keys']:
+        return f'value index keys (code, gr, ir), sorted within each chunk, of the {description}'
+    if suffixes == ['index', 'runs', 'ids']:
+        return f'value index row ids of each chunk, in the order of its keys, of the {description}'
+    if suffixes == ['index', 'keys']:
+        return f'value index keys (code, gr, ir), sorted, of the {description}'
+    if suffixes == ['index', 'ids']:
+        return f'value index row ids, in the order of the keys, of the {description}'
+    if suffixes == ['cube']:
+        return f'histogram cube, (stratum and code, count) pairs (see histogram_cube.py), of the {description}'
+    return description
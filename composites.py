@@ -0,0 +1,40 @@
+__all__ = [
+    'composite_rates',
+    'get_composite_inputs',
+    'save_composite_metrics',
+]
+
+import numpy as np
+
+from rate_tables import get_quantity_table
+from utils import composite_metrics
+
+# Rates whose (a, b) index is saved by metrics_calculations (`<group>_<rate>.frac.bin`) for the composite metrics
+composite_rates = sorted({rate for _, args in composite_metrics.values() for _, rate in args})
+
+
+def get_composite_inputs(metric: str):
+    _, args = composite_metrics[metric]
+    return [f'{group}_{rate}.frac.bin' for _, rate in args for group in ['j', 'i']]
+
+
+def _composite(compute, quantities, sample_size):
+    tables = [get_quantity_table(quantity, sample_size).ravel() for quantity in quantities]
+
+    def composite(*fractions):
+        # x / 0 and inf - inf are expected (e.g. for groups without false positives), giving inf and NaN
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return compute(*(table.take(f) for table, f in zip(tables, fractions)))
+
+    return composite
+
+
+# Composite metrics (see `composite_metrics`), each computed in a single streaming pass over the compact per-group
+# rate indices, instead of the dataset. Files that are up to date in the manifest are not recomputed.
+def save_composite_metrics(manifest, sample_size: int, metrics=composite_metrics, stats=None):
+    for metric in metrics:
+        compute, args = composite_metrics[metric]
+        quantities = [quantity for quantity, _ in args for _ in ['j', 'i']]
+        manifest.save_chunked(
+            f'{metric}.bin', _composite(compute, quantities, sample_size), get_composite_inputs(metric), stats=stats
+        )
@@ -0,0 +1,154 @@
+__all__ = [
+    'Float16Axis',
+    'CodeAxis',
+    'FractionAxis',
+    'EpsilonCurves',
+]
+
+import bisect
+from fractions import Fraction
+
+import numpy as np
+
+from strata import SparseCounts
+from utils import get_epsilon_fraction
+
+
+# Axes of the |diff| values, in ascending order. The rows of a metric are counted by the rank of their |diff|
+# on the axis, so the number of rows with |diff| < epsilon, for any epsilon, is a sum over a prefix of the axis.
+# Each kind of metric file has its own axis, on which |diff| is compared to epsilon as the values of the file are:
+# `count_close(epsilon)` is the length of the prefix (only 0 for epsilon = 0, i.e. perfect fairness).
+
+# float64 values, compared as float16
+class Float16Axis:
+    # the non-negative float16 values (up to inf) are in the order of their bits
+    size = 0x7C01
+
+    def __init__(self):
+        self.values = np.arange(self.size, dtype=np.uint16).view(np.float16)
+
+    # ranks of the defined values, and where they are defined
+    def get_ranks(self, diff):
+        diff = np.abs(diff.astype(np.float16))
+        defined = np.logical_not(np.isnan(diff))
+        return diff[defined].view(np.uint16), defined
+
+    def count_close(self, epsilon):
+        if epsilon == 0:
+            return np.searchsorted(self.values, 0, side='right')
+        return np.searchsorted(self.values, np.float16(epsilon), side='left')
+
+
+# codes into `diff_values` (see value_codes.DiffDictionary), compared as float64 values
+class CodeAxis:
+    def __init__(self, diff_values):
+        self.values = np.unique(np.abs(diff_values))
+        self.size = len(self.values)
+        self.nan_code = len(diff_values)
+        self.code_ranks = np.append(np.searchsorted(self.values, np.abs(diff_values)), 0)
+
+    def get_ranks(self, codes):
+        defined = codes != self.nan_code
+        return self.code_ranks.take(codes[defined]), defined
+
+    def count_close(self, epsilon):
+        if epsilon == 0:
+            return np.searchsorted(self.values, 0, side='right')
+        return np.searchsorted(self.values, epsilon, side='left')
+
+
+# (numerator, denominator) pairs of the two rates, compared exactly
+class FractionAxis:
+    def __init__(self, sample_size: int):
+        # reduced fractions of the rates (num / den, with num <= den <= n), in ascending order
+        num, den = np.meshgrid(np.arange(sample_size + 1), np.arange(sample_size + 1), indexing='ij')
+        gcd = np.maximum(np.gcd(num, den), 1)
+        keys = (num // gcd) * (sample_size + 1) + den // gcd
+        rates, rate_index = np.unique(np.where(num <= den, keys, 0), return_inverse=True)
+        # the undefined num/0 gets the rank of some rate, and is left out by get_ranks
+        self.rate_index = rate_index.reshape(num.shape)
+        p, q = rates // (sample_size + 1), np.maximum(rates % (sample_size + 1), 1)
+
+        # reduced fractions of |difference| of every pair of rates
+        diff_num = np.abs(p[:, np.newaxis] * q[np.newaxis, :] - p[np.newaxis, :] * q[:, np.newaxis])
+        diff_den = q[:, np.newaxis] * q[np.newaxis, :]
+        gcd = np.gcd(diff_num, diff_den)
+        diff_keys = (diff_num // gcd) * (sample_size ** 2 + 1) + diff_den // gcd
+        diffs, pair_ranks = np.unique(diff_keys, return_inverse=True)
+
+        # distinct fractions with denominators <= n^2 differ by more than the precision of float64,
+        # so they are sorted by their float values
+        p, q = diffs // (sample_size ** 2 + 1), diffs % (sample_size ** 2 + 1)
+        order = np.argsort(p / q, kind='stable')
+        self.num, self.den = p[order], q[order]
+        self.pair_ranks = np.argsort(order).take(pair_ranks).reshape(diff_keys.shape)
+        self.size = len(order)
+
+    def get_ranks(self, num_j, den_j, num_i, den_i):
+        defined = (den_j > 0) & (den_i > 0)
+        j, i = (self.rate_index[num[defined], den[defined]] for num, den in [(num_j, den_j), (num_i, den_i)])
+        return self.pair_ranks[j, i], defined
+
+    def count_close(self, epsilon):
+        if epsilon == 0:
+            return 1
+        eps = get_epsilon_fraction(epsilon)
+        return bisect.bisect_left(range(self.size), eps, key=lambda r: Fraction(int(self.num[r]), int(self.den[r])))
+
+
+# Per-stratum cumulative histograms of the |diff| of a metric, on one of the axes above, counted chunk by chunk.
+# The probability of being epsilon-close to perfect fairness in each stratum is then computed for any epsilon,
+# without reading the metric again.
+class EpsilonCurves:
+    def __init__(self, axis, n_strata: int):
+        self.axis = axis
+        self.n_strata = n_strata
+        self.totals = np.zeros(n_strata, dtype=np.int64)
+        self._counts = SparseCounts()
+        self._keys = self._cumulative = None
+
+    # `strata` are the keys of the strata of all rows, `ranks` those of the defined rows (see the axes' get_ranks)
+    def add(self, strata, ranks, defined):
+        strata = np.asarray(strata, dtype=np.int64)
+        self.totals += np.bincount(strata, minlength=self.n_strata)
+        self._counts.add(strata[defined] * self.axis.size + ranks)
+        self._keys = None
+        return self
+
+    # the counts of the defined rows, as (stratum * axis size + rank, count) pairs, e.g. to save partial results
+    def get_counts(self):
+        return self._counts.result()
+
+    # adds the curves of other rows (e.g. of another shard of the dataset), given by their totals and counts
+    def merge(self, totals, keys, counts):
+        self.totals += totals
+        self._counts.add(keys, counts)
+        self._keys = None
+        return self
+
+    # Curves of coarser strata, e.g. of GR from those of the (GR, IR) strata: `strata_map[s]` is the new stratum of s
+    def marginalize(self, strata_map, n_strata: int):
+        curves = EpsilonCurves(self.axis, n_strata)
+        curves.totals = np.bincount(strata_map, weights=self.totals, minlength=n_strata).astype(np.int64)
+        keys, counts = self.get_counts()
+        strata, ranks = np.divmod(keys, self.axis.size)
+        curves._counts.add(np.asarray(strata_map).take(strata) * self.axis.size + ranks, counts)
+        return curves
+
+    # the number of rows with a rank below `k` in each stratum, for each of the `ks`: strata x ks
+    def _count_below(self, ks):
+        if self._keys is None:
+            self._keys, counts = self._counts.result()
+            self._cumulative = np.concatenate([[0], np.cumsum(counts)])
+        starts = np.arange(self.n_strata)[:, np.newaxis] * self.axis.size
+        ends = starts + np.asarray(ks)[np.newaxis, :]
+        cumulative = self._cumulative.take(np.searchsorted(self._keys, ends))
+        return cumulative - self._cumulative.take(np.searchsorted(self._keys, starts))
+
+    # numbers of rows with a defined value in each stratum
+    def get_defined(self):
+        return self._count_below([self.axis.size])[:, 0]
+
+    # numbers of rows epsilon-close to perfect fairness in each stratum, for each epsilon: strata x epsilons
+    def get_close(self, epsilons):
+        return self._count_below([self.axis.count_close(epsilon) for epsilon in epsilons])
@@ -0,0 +1,119 @@
+__all__ = [
+    'jit_available',
+    'get_fused_metrics',
+]
+
+import numpy as np
+import pandas as pd
+
+from rate_tables import get_rate_index, get_rate_table
+from utils import data_cols, diff_metric_rates, rate_cells, ratio_metric_rates
+
+try:
+    import numba
+except ImportError:  # the NumPy implementation is used instead
+    numba = None
+
+jit_available = numba is not None
+
+# weights of the dataset columns in the numerator (a) and the rest of the denominator (b) of each rate
+_rate_weights = np.array(
+    [
+        [[int(col[2:] in cells) for col in data_cols[:4]] for cells in rate_cells[rate]]
+        for rate in rate_cells
+    ],
+    dtype=np.int64,
+)  # shape: rates x (a, b) x cells of one group
+
+
+def _get_metric_arrays(metrics):
+    rates = list(rate_cells)
+    metric_rates = np.array([rates.index({**diff_metric_rates, **ratio_metric_rates}[m]) for m in metrics])
+    is_ratio = np.array([m in ratio_metric_rates for m in metrics])
+    return metric_rates, is_ratio
+
+
+# One pass over the rows of a chunk: group sums, rates and all the metrics, as in the NumPy implementation below
+def _fused_loop(cells, rate_weights, metric_rates, is_ratio, values):
+    n_rates = rate_weights.shape[0]
+    rates = np.empty((2, n_rates), dtype=np.float64)
+
+    for r in range(cells.shape[0]):
+        for g in range(2):
+            for k in range(n_rates):
+                a = 0
+                b = 0
+                for c in range(4):
+                    a += rate_weights[k, 0, c] * cells[r, 4 * g + c]
+                    b += rate_weights[k, 1, c] * cells[r, 4 * g + c]
+                rates[g, k] = a / (a + b)  # NaN if a + b == 0, as in NumPy (error_model='numpy' below)
+
+        for m in range(metric_rates.shape[0]):
+            i_rate = rates[0, metric_rates[m]]
+            j_rate = rates[1, metric_rates[m]]
+            values[m, r] = j_rate / i_rate if is_ratio[m] else j_rate - i_rate
+
+
+if jit_available:
+    # division by zero gives inf or NaN instead of raising an error, so the values are bitwise equal to NumPy's
+    _fused_loop = numba.njit(nogil=True, cache=True, error_model='numpy')(_fused_loop)
+
+
+def _get_fused_metrics_jit(cells, metrics, sample_size: int):
+    metric_rates, is_ratio = _get_metric_arrays(metrics)
+    values = np.empty((len(metrics), len(cells)), dtype=np.float64)
+    _fused_loop(np.asarray(cells), _rate_weights, metric_rates, is_ratio, values)
+    return values
+
+
+def _get_fused_metrics_numpy(cells, metrics, sample_size: int):
+    metric_rates, is_ratio = _get_metric_arrays(metrics)
+    df = pd.DataFrame(cells, columns=data_cols, copy=False)
+    table = get_rate_table(sample_size)
+    rates = list(rate_cells)
+    values = np.empty((len(metrics), len(df)), dtype=np.float64)
+
+    for m in range(len(metrics)):
+        rate = rates[metric_rates[m]]
+        i_rate, j_rate = (table.ravel().take(get_rate_index(df, rate, g, table.shape[1])) for g in ['i', 'j'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[m] = j_rate / i_rate if is_ratio[m] else j_rate - i_rate
+
+    return values
+
+
+# Values of the given metrics for a chunk of the dataset (int8 array of `data_cols`), with shape metrics x rows.
+# A single compiled loop with numba, when it is installed, otherwise a few NumPy passes per metric.
+def get_fused_metrics(cells, metrics, sample_size: int, jit=jit_available):
+    if jit:
+        return _get_fused_metrics_jit(cells, metrics, sample_size)
+    return _get_fused_metrics_numpy(cells, metrics, sample_size)
+
+
+# Equivalence check of the implementations, on all confusion matrices of a small sample size:
+# python fused_kernels.py [sample_size]
+if __name__ == '__main__':
+    import sys
+
+    from rate_tables import get_diff_metric_lut, get_ratio_metric_lut
+    from sets_creation import genset_k_by_inc
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    cells = genset_k_by_inc(8, n)
+    metrics = list(diff_metric_rates) + list(ratio_metric_rates)
+
+    # the lookup-table functions give the same values as the utils functions
+    values = get_fused_metrics(cells, metrics, n, jit=False)
+    df = pd.DataFrame(cells, columns=data_cols)
+    table = get_rate_table(n)
+    for m, metric in enumerate(metrics):
+        get_metric_lut = get_diff_metric_lut if metric in diff_metric_rates else get_ratio_metric_lut
+        assert values[m].tobytes() == get_metric_lut(df, metric, table).tobytes(), metric
+    print(f'NumPy implementation: OK ({len(cells)} rows)')
+
+    if jit_available:
+        jit_values = get_fused_metrics(cells, metrics, n, jit=True)
+        assert jit_values.tobytes() == values.tobytes()
+        print('numba implementation: OK')
+    else:
+        print('numba is not installed, the compiled implementation is not checked')
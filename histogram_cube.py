@@ -0,0 +1,80 @@
+__all__ = [
+    'get_cube_file',
+    'save_histogram_cube',
+    'HistogramCube',
+]
+
+import numpy as np
+
+from strata import SparseCounts, get_stratum_keys
+from value_codes import DiffDictionary, get_histogram_from_counts
+
+
+# Histogram cube of a difference metric: the number of rows with each value (code, see value_codes.DiffDictionary)
+# in each (GR, IR) stratum, NaNs included. Histograms of any stratum and with any bins are computed from it,
+# without reading the metric file again. It is sparse (a stratum has only a few of the possible values), so it is
+# saved as (key, count) pairs sorted by key, with key = stratum * (nan_code + 1) + code (stratum: see strata.py).
+def get_cube_file(metric: str):
+    return f'{metric}.cube.bin'
+
+
+# Counts the cube in one streaming pass over the metric file (float64 values or codes).
+# A class rather than a closure: the definition hash of an instance covers its code, not the I/O statistics it updates.
+class _CubeCounter:
+    def __init__(self, manifest, metric: str, sample_size: int, input_format='float64', stats=None):
+        self.manifest = manifest
+        self.sample_size = sample_size
+        self.input_format = input_format
+        self.stats = stats
+        metric_file = f'{metric}.codes.bin' if input_format == 'codes' else f'{metric}.bin'
+        self.inputs = ['gr.key.bin', 'ir.key.bin', metric_file]
+
+    def __call__(self):
+        dictionary = DiffDictionary(self.sample_size)
+        n_codes = dictionary.nan_code + 1
+        to_codes = (lambda codes: codes) if self.input_format == 'codes' else dictionary.encode_values
+
+        cube = SparseCounts()
+        for gr_key, ir_key, values in zip(*(self.manifest.read_chunks(fn, stats=self.stats) for fn in self.inputs)):
+            strata = get_stratum_keys(gr_key, ir_key, self.sample_size).astype(np.int64)
+            cube.add(strata * n_codes + to_codes(values))
+        keys, counts = cube.result()
+        return np.stack([keys, counts], axis=1).ravel()
+
+
+# The cube of a difference metric, unless it is up to date in the manifest; returns whether it was computed
+def save_histogram_cube(manifest, metric: str, sample_size: int, input_format='float64', stats=None):
+    count = _CubeCounter(manifest, metric, sample_size, input_format, stats)
+    return manifest.save(get_cube_file(metric), count, count.inputs)
+
+
+# The cube of a difference metric, loaded from the manifest, or given as saved (e.g. merged from shards, see shards.py)
+class HistogramCube:
+    def __init__(self, manifest, metric: str, sample_size: int, cube=None):
+        self.sample_size = sample_size
+        self.values = DiffDictionary(sample_size).values
+        self.n_codes = len(self.values) + 1
+        cube = manifest.load(get_cube_file(metric)) if cube is None else cube
+        self.keys, self.counts = cube.reshape(-1, 2).T
+
+    # number of rows with each code in the stratum (the last one counting NaNs)
+    def get_counts(self, gr_key, ir_key):
+        start = get_stratum_keys(np.intp(gr_key), ir_key, self.sample_size) * self.n_codes
+        lo, hi = np.searchsorted(self.keys, [start, start + self.n_codes])
+        counts = np.zeros(self.n_codes, dtype=np.int64)
+        counts[self.keys[lo:hi] - start] = self.counts[lo:hi]
+        return counts
+
+    # Same as np.histogram(values, bins) on the defined values of the stratum, the number of NaNs and of all rows
+    def get_histogram(self, gr_key, ir_key, bins):
+        counts = self.get_counts(gr_key, ir_key)
+        return get_histogram_from_counts(self.values, counts, bins), counts[-1], counts.sum()
+
+    # numbers of rows and of NaNs of every stratum, with shape (n + 1) x (n + 1), indexed by the GR and IR keys
+    def get_totals(self):
+        n_strata = (self.sample_size + 1) ** 2
+        strata = self.keys // self.n_codes
+        totals = np.bincount(strata, weights=self.counts, minlength=n_strata).astype(np.int64)
+        nan = self.keys % self.n_codes == self.n_codes - 1
+        nans = np.bincount(strata[nan], weights=self.counts[nan], minlength=n_strata).astype(np.int64)
+        return totals.reshape(self.sample_size + 1, -1), nans.reshape(self.sample_size + 1, -1)
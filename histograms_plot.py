@@ -8,15 +8,17 @@
 # In[ ]:
 
 
-import gc
 import os
 import warnings
 from os import path
 
 import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
 
+from chunked_io import IOStats
+from histogram_cube import HistogramCube, save_histogram_cube
+from manifest import Manifest
+from shards import MERGED_FILE, ShardAggregates
+from strata import get_ratio_keys
 from utils import Timer
 
 warnings.filterwarnings('ignore')
@@ -34,6 +36,13 @@ os.makedirs(plots_dir, exist_ok=True)
 os.makedirs(calculations_dir, exist_ok=True)
 os.makedirs(timer_dir, exist_ok=True)
 
+# 'codes' reads the dictionary-encoded metric files, saved by metrics_calculations with `output_format = 'codes'`,
+# to build the histogram cubes, without decoding the values
+input_format = 'float64'
+# directory of the shards of the dataset computed separately (see shards.py), e.g. shards.get_shards_dir(sample_size):
+# the cubes are then taken from their merged aggregates
+shards_dir = None
+
 metrics = {
     'acc_equality_diff.bin': 'Accuracy equality',
     'equal_opp_diff.bin': 'Equal opportunity',
@@ -61,12 +70,23 @@ plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 # In[ ]:
 
 
-# load IR & GR data for all confusion matrices of selected sample size
-with open(path.join(calculations_dir, 'gr.bin'), 'rb') as f:
-    gr = pd.DataFrame(np.fromfile(f).astype(np.float16), columns=['gr'])
+# only files computed from the same dataset, with their recorded dtype and length, are loaded
+manifest = Manifest(calculations_dir)
+
+# files are read in chunks, the next one on a background thread while the current one is converted
+io_stats = IOStats()
+merged = ShardAggregates.load(path.join(shards_dir, MERGED_FILE)) if shards_dir is not None else None
 
-with open(path.join(calculations_dir, 'ir.bin'), 'rb') as f:
-    ir = pd.DataFrame(np.fromfile(f).astype(np.float16), columns=['ir'])
+# histogram cubes of the metrics (see histogram_cube.py), computed in one streaming pass over each metric file
+# and saved to the calculations directory; the figures are rendered from them, with any number of bins
+cubes = dict()
+for m_file in metrics:
+    metric = m_file.replace('.bin', '')
+    if shards_dir is not None:
+        cubes[m_file] = HistogramCube(None, metric, sample_size, merged.get_cube(metric))
+        continue
+    save_histogram_cube(manifest, metric, sample_size, input_format, io_stats)
+    cubes[m_file] = HistogramCube(manifest, metric, sample_size)
 
 
 # ## Histograms with highlighted undefined values
@@ -79,11 +99,7 @@ def plot_histograms(metric_info, grs, irs, ratios_labels, bins_n):
     ir_labels = ratios_labels[::-1]
     gr_labels = ratios_labels
 
-    with open(path.join(calculations_dir, m_file), 'rb') as f:
-        df = pd.concat([gr, ir, pd.DataFrame(np.fromfile(f), columns=[m_name])], axis=1)
-
-    # filter to get only results for selected ratios
-    df = df.loc[df.ir.isin(irs) & df.gr.isin(grs)]
+    cube = cubes[m_file]
 
     # list like: [['a00', 'a00n', 'a01', 'a01n',...], ...]
     mosaic = [[f'a{i}{g}{x}' for g in range(len(grs)) for x in ['', 'n']] for i in range(len(irs))]
@@ -103,14 +119,10 @@ def plot_histograms(metric_info, grs, irs, ratios_labels, bins_n):
         for g, gr_val in enumerate(grs):
 
             # separate nans and numbers
-            df_tmp = df.loc[(df.ir == ir_val) & (df.gr == gr_val)]
-            total = df_tmp.shape[0]
-
-            df_not_nan = df_tmp.loc[np.logical_not(np.isnan(df_tmp[m_name]))]
-            nan_prob = df_tmp.loc[np.isnan(df_tmp[m_name])].shape[0] / total if total > 0 else 0
+            (binned, edges), nan_count, total = cube.get_histogram(gr_val, ir_val, bins_n)
 
             # prepare data for plotting
-            binned, edges = np.histogram(df_not_nan[m_name], bins=bins_n)
+            nan_prob = nan_count / total if total > 0 else 0
             binned = binned / total
 
             # plot not nans
@@ -132,9 +144,6 @@ def plot_histograms(metric_info, grs, irs, ratios_labels, bins_n):
                 axs[f'a{i}{g}'].set_xticklabels([])
                 axs[f'a{i}{g}n'].set_xticks([0], [''])
 
-    del df
-    gc.collect()
-
     return fig
 
 
@@ -146,8 +155,8 @@ ratios = (
 )
 ratios_labels = ['1/28', '1/4', '1/2', '3/4', '27/28'] if sample_size == 56 else ['1/12', '1/4', '1/2', '3/4', '11/12']
 
-grs = np.float16(ratios)
-irs = np.float16(ratios[::-1])
+grs = get_ratio_keys(ratios, sample_size)
+irs = get_ratio_keys(ratios[::-1], sample_size)
 
 BINS = 109
 
@@ -171,12 +180,7 @@ for metric_info in metrics.items():
 def plot_histograms_no_nan(metric_info, grs, irs, ratios_labels, bins_n):
     m_file, m_name = metric_info
 
-    with open(path.join(calculations_dir, m_file), 'rb') as f:
-        df = pd.concat([gr, ir, pd.DataFrame(np.fromfile(f).astype(np.float64), columns=[m_name])], axis=1)
-
-    # filter to get only results for selected ratios
-    df = df.loc[df.ir.isin(irs) & df.gr.isin(grs)]
-    df = df.replace(np.inf, np.nan)
+    cube = cubes[m_file]
 
     fig, axs = plt.subplots(
         len(irs),
@@ -193,14 +197,8 @@ def plot_histograms_no_nan(metric_info, grs, irs, ratios_labels, bins_n):
     for i, ir_val in enumerate(irs):
         for g, gr_val in enumerate(grs):
 
-            # separate nans and numbers
-            df_tmp = df.loc[(df.ir == ir_val) & (df.gr == gr_val)]
-            total = df_tmp.shape[0]
-
-            df_not_nan = df_tmp.loc[np.logical_not(np.isnan(df_tmp[m_name]))]
-
             # prepare data for plotting
-            binned, edges = np.histogram(df_not_nan[m_name], bins=bins_n)
+            (binned, edges), _, total = cube.get_histogram(gr_val, ir_val, bins_n)
             binned = binned / total
 
             # plot not nans
@@ -217,9 +215,6 @@ def plot_histograms_no_nan(metric_info, grs, irs, ratios_labels, bins_n):
             else:
                 axs[i, g].set_xticklabels([])
 
-    del df
-    gc.collect()
-
     return fig
 
 
@@ -234,6 +229,7 @@ for metric_info in metrics.items():
     plt.close(fig)
     timer.checkpoint(f"plot {metric_info[1]} without NaNs")
 
+io_stats.report(timer, 'Metric files')
 timer.reset()
 timer.print()
 timer.to_file(fn='histograms.csv')
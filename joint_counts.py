@@ -0,0 +1,72 @@
+__all__ = [
+    'get_pair_key',
+    'PairCounts',
+    'get_measure_pairs',
+    'count_pairs',
+]
+
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from strata import SparseCounts
+
+
+# Joint counts of two columns as float16 values (as plotted), keyed by their bit patterns:
+# key = x_bits * 2^16 + y_bits. -0.0 and 0.0 get the same key.
+def _get_bits(values):
+    return (np.asarray(values).astype(np.float16) + np.float16(0)).view(np.uint16).astype(np.int64)
+
+
+def get_pair_key(x, y):
+    return (_get_bits(x) << 16) | _get_bits(y)
+
+
+# 2-D count table of the (x, y) values of a pair of columns, counted chunk by chunk.
+# Rows where either value is NaN are left out.
+class PairCounts:
+    def __init__(self, x: str, y: str):
+        self.x = x
+        self.y = y
+        self._counts = SparseCounts()
+
+    def add(self, x_values, y_values):
+        x_values, y_values = (np.asarray(values).astype(np.float16, copy=False) for values in (x_values, y_values))
+        defined = np.logical_not(np.isnan(x_values) | np.isnan(y_values))
+        self._counts.add(get_pair_key(x_values[defined], y_values[defined]))
+        return self
+
+    # one row per distinct (x, y) pair, sorted by x, then y, with the columns named `x_name`, `y_name` and 'count'
+    def to_frame(self, x_name: str = None, y_name: str = None):
+        keys, counts = self._counts.result()
+        x_values = (keys >> 16).astype(np.uint16).view(np.float16)
+        y_values = (keys & 0xFFFF).astype(np.uint16).view(np.float16)
+        order = np.lexsort((y_values, x_values))
+        return pd.DataFrame(
+            {
+                x_name or self.x: x_values[order].astype(np.float64),
+                y_name or self.y: y_values[order].astype(np.float64),
+                'count': counts[order],
+            }
+        )
+
+
+# every (performance measure, fairness measure) pair, and every pair of performance or of fairness measures
+def get_measure_pairs(performance_files, fairness_files):
+    pairs = [(x, y) for x in performance_files for y in fairness_files]
+    return pairs + list(combinations(performance_files, 2)) + list(combinations(fairness_files, 2))
+
+
+# Count tables of the given pairs of files of the manifest, in a single chunked pass that reads each file once;
+# returns {(x file, y file): PairCounts}
+def count_pairs(manifest, pairs, stats=None):
+    files = list(dict.fromkeys(fn for pair in pairs for fn in pair))
+    tables = {(x, y): PairCounts(x, y) for x, y in pairs}
+
+    for chunks in zip(*(manifest.read_chunks(fn, stats=stats) for fn in files)):
+        # each column is cast to float16 once, for all its pairs
+        columns = {fn: chunk.astype(np.float16) for fn, chunk in zip(files, chunks)}
+        for (x, y), table in tables.items():
+            table.add(columns[x], columns[y])
+    return tables
@@ -0,0 +1,275 @@
+__all__ = [
+    'Manifest',
+    'get_file_hash',
+    'get_definition_hash',
+]
+
+import hashlib
+import inspect
+import json
+import os
+from os import path
+from time import perf_counter
+from types import FunctionType
+
+import numpy as np
+import pandas as pd
+
+from chunked_io import DEFAULT_CHUNK_ROWS, ChunkReader, ChunkWriter
+from column_semantics import describe_column
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def get_file_hash(fn: str, block_size=1 << 26):
+    h = hashlib.blake2b(digest_size=16)
+    with open(fn, 'rb') as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Hash of the code that computes a value: the source of the function (e.g. a lambda passed to Manifest.save)
+# and, recursively, of the functions, classes and small values it refers to. Large arrays and data frames are data,
+# not definitions, and they are covered by the dataset hash.
+def get_definition_hash(compute):
+    h = hashlib.blake2b(digest_size=16)
+    _update_definition_hash(h, compute, set())
+    return h.hexdigest()
+
+
+def _update_definition_hash(h, obj, visited):
+    if id(obj) in visited:
+        return
+    visited.add(id(obj))
+
+    if isinstance(obj, FunctionType):
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            h.update(obj.__code__.co_code)
+        for name in _get_code_names(obj.__code__):
+            if name in obj.__globals__:
+                _update_definition_hash(h, obj.__globals__[name], visited)
+        # values captured by closures, e.g. the rate of a lambda created in a loop
+        for cell in obj.__closure__ or ():
+            try:
+                _update_definition_hash(h, cell.cell_contents, visited)
+            except ValueError:  # empty cell
+                pass
+    elif inspect.ismethod(obj):  # bound methods, e.g. DiffDictionary(n).encode_rates: their code and their instance
+        _update_definition_hash(h, obj.__func__, visited)
+        _update_definition_hash(h, obj.__self__, visited)
+    elif inspect.isclass(obj):
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            h.update(obj.__qualname__.encode())
+        for member in vars(obj).values():
+            if isinstance(member, (FunctionType, staticmethod, classmethod)):
+                _update_definition_hash(h, getattr(member, '__func__', member), visited)
+    elif hasattr(obj, 'py_func'):  # functions compiled with numba
+        _update_definition_hash(h, obj.py_func, visited)
+    elif isinstance(obj, (str, int, float, bool, tuple, list, dict)) or obj is None:
+        h.update(repr(obj).encode())
+    elif isinstance(obj, np.ndarray):
+        if obj.nbytes <= 1 << 20:
+            h.update(obj.tobytes())
+    elif not inspect.ismodule(obj) and type(obj).__module__.split('.')[0] not in ('builtins', 'numpy', 'pandas'):
+        # instances of the repository classes, e.g. DiffDictionary: their class, and their parameters of simple types
+        # (e.g. the zone size of a zone mapper), but not the objects they use (e.g. the I/O statistics they update)
+        _update_definition_hash(h, type(obj), visited)
+        for name, value in vars(obj).items() if hasattr(obj, '__dict__') else ():
+            if isinstance(value, (str, int, float, bool, tuple, list)) or value is None:
+                h.update(f'{name}={value!r}'.encode())
+
+
+# global names used by the code, including nested code (comprehensions, inner functions)
+def _get_code_names(code):
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names += _get_code_names(const)
+    return names
+
+
+# Manifest of the files in a calculations directory (manifest.json), recording for each file:
+# the hash of the dataset and of the definition it was computed from, its dtype, number of rows, sample size,
+# semantics (see column_semantics.py) and computation time.
+# Together, the files form a columnar store: each one is a headerless array (a column, or a flattened table)
+# that can be mapped without copying (`view`), and any subset of the columns can be loaded (`project`).
+# A virtual dataset (`virtual_dataset=(name, get_chunk)`), computed chunk by chunk instead of being read from a file,
+# is identified by the hash of the code computing it.
+class Manifest:
+    def __init__(self, directory: str, dataset_path: str = None, virtual_dataset=None, sample_size: int = None):
+        self.directory = directory
+        self.fn = path.join(directory, MANIFEST_FILE)
+
+        if path.exists(self.fn):
+            with open(self.fn, 'r') as f:
+                self.content = json.load(f)
+        else:
+            self.content = {'dataset': None, 'files': {}}
+
+        if dataset_path is not None:
+            self.content['dataset'] = self._get_dataset_info(dataset_path)
+            self._write()
+        elif virtual_dataset is not None:
+            name, get_chunk = virtual_dataset
+            self.content['dataset'] = {'virtual': name, 'hash': get_definition_hash(get_chunk)}
+            self._write()
+        if sample_size is not None and self.content['dataset'] is not None:
+            self.content['dataset']['sample_size'] = sample_size
+            self._write()
+
+    @property
+    def dataset_hash(self):
+        return self.content['dataset']['hash'] if self.content['dataset'] else None
+
+    # the hash is recomputed only if the dataset file has changed since the last run
+    def _get_dataset_info(self, dataset_path):
+        stat = os.stat(dataset_path)
+        info = {'path': dataset_path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        known = self.content['dataset']
+        if known and all(known.get(k) == v for k, v in info.items()):
+            return known
+        return {**info, 'hash': get_file_hash(dataset_path)}
+
+    def _write(self):
+        tmp_fn = f'{self.fn}.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.content, f, indent=2)
+        os.replace(tmp_fn, self.fn)
+
+    def is_up_to_date(self, fn: str, definition_hash: str):
+        entry = self.content['files'].get(fn)
+        return (
+            entry is not None
+            and entry['dataset_hash'] == self.dataset_hash
+            and entry['definition_hash'] == definition_hash
+            and path.exists(path.join(self.directory, fn))
+            and path.getsize(path.join(self.directory, fn)) == entry['rows'] * np.dtype(entry['dtype']).itemsize
+        )
+
+    def record(self, fn: str, definition_hash: str, dtype, rows: int, seconds: float):
+        self.content['files'][fn] = {
+            'dataset_hash': self.dataset_hash,
+            'definition_hash': definition_hash,
+            'dtype': np.dtype(dtype).str,
+            'rows': int(rows),
+            'sample_size': self.content['dataset'].get('sample_size') if self.content['dataset'] else None,
+            'semantics': describe_column(fn),
+            'seconds': seconds,
+        }
+        self._write()
+
+    # Computes and saves the values, unless the file is up to date; returns whether they were computed.
+    # `inputs` are the files of the manifest the values are computed from, so that they are recomputed
+    # whenever any of the inputs' definitions changes.
+    def save(self, fn: str, compute, inputs=()):
+        definition_hash = self._get_definition_hash(compute, inputs)
+        if self.is_up_to_date(fn, definition_hash):
+            return False
+
+        start_t = perf_counter()
+        values = compute()
+        values = values.to_numpy() if hasattr(values, 'to_numpy') else np.asarray(values)
+        with open(path.join(self.directory, fn), 'wb+') as f:
+            values.tofile(f)
+        self.record(fn, definition_hash, values.dtype, len(values), perf_counter() - start_t)
+        return True
+
+    # Like save, but streamed: `compute` gets one chunk of each of the `inputs` files at a time,
+    # and its results are written while the next chunks are being read and computed
+    def save_chunked(self, fn: str, compute, inputs, chunk_rows: int = DEFAULT_CHUNK_ROWS, stats=None):
+        definition_hash = self._get_definition_hash(compute, inputs)
+        if self.is_up_to_date(fn, definition_hash):
+            return False
+
+        start_t = perf_counter()
+        readers = [self.read_chunks(input_fn, chunk_rows, stats) for input_fn in inputs]
+        with ChunkWriter(path.join(self.directory, fn), stats=stats) as writer:
+            for chunks in zip(*readers):
+                writer.write(compute(*chunks))
+        self.record(fn, definition_hash, writer.dtype, writer.rows, perf_counter() - start_t)
+        return True
+
+    # Like save_chunked, for several files computed together: `compute()` yields a chunk of each of the files at a time
+    # (e.g. the keys and row ids of a sorted index), read from the `inputs` as it needs them
+    def save_streamed(self, fns, compute, inputs, stats=None):
+        definition_hash = self._get_definition_hash(compute, inputs)
+        if all(self.is_up_to_date(fn, definition_hash) for fn in fns):
+            return False
+
+        start_t = perf_counter()
+        writers = [ChunkWriter(path.join(self.directory, fn), stats=stats) for fn in fns]
+        try:
+            for chunks in compute():
+                for writer, chunk in zip(writers, chunks):
+                    writer.write(chunk)
+        finally:
+            for writer in writers:
+                writer.close()
+        for fn, writer in zip(fns, writers):
+            self.record(fn, definition_hash, writer.dtype, writer.rows, perf_counter() - start_t)
+        return True
+
+    def _get_definition_hash(self, compute, inputs):
+        definition_hash = get_definition_hash(compute)
+        if inputs:
+            hashes = [definition_hash] + [self.check(input_fn)['definition_hash'] for input_fn in inputs]
+            definition_hash = hashlib.blake2b(' '.join(hashes).encode(), digest_size=16).hexdigest()
+        return definition_hash
+
+    # Refuses to load files that are not in the manifest, were computed from another dataset
+    # or do not match their recorded dtype and length
+    def check(self, fn: str):
+        entry = self.content['files'].get(fn)
+        if entry is None:
+            raise ValueError(f'{fn} is not in the manifest of {self.directory}, recompute it with metrics_calculations')
+        if entry['dataset_hash'] != self.dataset_hash:
+            raise ValueError(f'{fn} was computed from another dataset than the other files in {self.directory}')
+
+        size = path.getsize(path.join(self.directory, fn))
+        if size != entry['rows'] * np.dtype(entry['dtype']).itemsize:
+            raise ValueError(f'{fn} has {size} bytes, which does not match its manifest entry')
+        return entry
+
+    # chunks of the file, read ahead on a background thread (see chunked_io.py)
+    def read_chunks(self, fn: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, stats=None):
+        entry = self.check(fn)
+        return ChunkReader(path.join(self.directory, fn), entry['dtype'], chunk_rows, stats)
+
+    # the whole file; with `dtype`, the values are converted chunk by chunk, while the next chunk is being read
+    def load(self, fn: str, dtype=None, stats=None):
+        entry = self.check(fn)
+        return self.read_chunks(fn, stats=stats).read_all(entry['rows'], dtype)
+
+    # names of the columns (files without the .bin extension) computed from the current dataset
+    @property
+    def columns(self):
+        return [
+            fn.removesuffix('.bin')
+            for fn, entry in self.content['files'].items()
+            if entry['dataset_hash'] == self.dataset_hash
+        ]
+
+    # Read-only view of a column (e.g. 'gr' or 'gr.bin'), mapped from its file without copying;
+    # pages are read from the disk when they are accessed
+    def view(self, column: str):
+        fn = column if column.endswith('.bin') else f'{column}.bin'
+        entry = self.check(fn)
+        if entry['rows'] == 0:
+            return np.empty(0, dtype=entry['dtype'])
+        return np.memmap(path.join(self.directory, fn), mode='r', dtype=entry['dtype'], shape=(entry['rows'],))
+
+    # Projection: only the given columns, all of the same length, as a data frame;
+    # `rows` (a slice, mask or ids) selects the rows to load, e.g. project(['gr', 'stat_parity'], slice(0, 1000))
+    def project(self, columns, rows=None):
+        views = {column.removesuffix('.bin'): self.view(column) for column in columns}
+        lengths = {len(v) for v in views.values()}
+        if len(lengths) > 1:
+            raise ValueError(f'Columns {list(views)} have different lengths: {lengths}')
+        if rows is None:
+            return pd.DataFrame({name: np.asarray(v) for name, v in views.items()})
+        return pd.DataFrame({name: v[rows] for name, v in views.items()})
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Agreement between the difference metrics
+#
+# Pearson and Spearman correlations between every pair of difference metrics, for each GR and IR
+
+# In[ ]:
+
+
+import os
+from os import path
+
+import numpy as np
+
+from chunked_io import IOStats
+from manifest import Manifest
+from stratum_correlation import StratumCorrelation
+from utils import Timer, diff_metric_rates
+from value_codes import DiffDictionary
+
+
+# In[ ]:
+
+
+sample_size = 56
+ratio_types = ['ir', 'gr']
+# 'codes' reads the dictionary-encoded difference metrics, saved by metrics_calculations with `output_format = 'codes'`
+input_format = 'float64'
+
+calculations_dir = path.join('out', 'calculations', f'n{sample_size}')
+timer_dir = path.join('out', 'time')
+os.makedirs(timer_dir, exist_ok=True)
+
+# only files computed from the same dataset, with their recorded dtype and length, are loaded
+manifest = Manifest(calculations_dir)
+io_stats = IOStats()
+
+metrics = list(diff_metric_rates)
+dictionary = DiffDictionary(sample_size)
+
+
+# In[ ]:
+
+
+# chunks of the keys of the strata (see strata.py), and of the values and codes of every metric
+def read_metrics():
+    suffix = '.codes.bin' if input_format == 'codes' else '.bin'
+    files = [f'{ratio}.key.bin' for ratio in ratio_types] + [f'{metric}{suffix}' for metric in metrics]
+
+    for chunks in zip(*(manifest.read_chunks(fn, stats=io_stats) for fn in files)):
+        keys, chunks = chunks[: len(ratio_types)], chunks[len(ratio_types) :]
+        if input_format == 'codes':
+            yield keys, [dictionary.decode(codes) for codes in chunks], chunks
+        else:
+            yield keys, chunks, [dictionary.encode_values(values) for values in chunks]
+
+
+# Correlations of every pair of metrics in each stratum of each ratio, in two chunked passes over the metric files
+# read side by side: the ranks of the values in their strata are counted in the first one (see stratum_correlation.py)
+def correlate():
+    correlations = {
+        ratio: StratumCorrelation(len(metrics), sample_size + 1, dictionary.nan_code) for ratio in ratio_types
+    }
+    for keys, _, codes in read_metrics():
+        for ratio, ratio_keys in zip(ratio_types, keys):
+            correlations[ratio].count_codes(ratio_keys, codes)
+    timer.checkpoint("count ranks")
+
+    for keys, values, codes in read_metrics():
+        for ratio, ratio_keys in zip(ratio_types, keys):
+            correlations[ratio].add(ratio_keys, values, codes)
+    timer.checkpoint("correlate")
+    return correlations
+
+
+# In[ ]:
+
+
+timer = Timer().start()
+
+# strata x metrics x metrics tensors, of the strata where any metric is defined
+for ratio, correlation in correlate().items():
+    counts = correlation.get_counts()
+    strata = np.flatnonzero(counts.max(axis=(1, 2)))
+    np.savez(
+        path.join(calculations_dir, f'correlations_{ratio}.npz'),
+        metrics=metrics,
+        **{ratio: strata / sample_size},
+        count=counts[strata],
+        pearson=correlation.get_pearson()[strata],
+        spearman=correlation.get_spearman()[strata],
+    )
+timer.checkpoint("save correlations")
+
+io_stats.report(timer, 'Metric files')
+timer.reset()
+timer.print()
+timer.to_file(fn='metric_correlations.csv')
@@ -0,0 +1,347 @@
+__all__ = [
+    'get_metric_stages',
+    'get_ratio_category_counts',
+    'rate_files',
+]
+
+import numpy as np
+import pandas as pd
+
+from composites import composite_rates
+from fused_kernels import get_fused_metrics
+from rate_tables import (
+    get_rate_index,
+    get_rate_index_dtype,
+    get_rate_state_table,
+    get_rate_table,
+    get_ratio_categories,
+    get_undefined_mask,
+)
+from scheduler import Stage
+from strata import get_stratum_key_dtype
+from utils import *
+from value_codes import DiffDictionary
+from value_index import get_index_id_dtype, get_index_key_dtype, get_index_keys
+
+# Per-group rates saved to their own files (the other ones are only used to compute metrics)
+rate_files = ['ppv', 'npv', 'tpr', 'fpr']
+
+# Functions of the pandas backend
+pandas_rates = {
+    ('ppv', 'i'): get_positive_predictive_value_i,
+    ('ppv', 'j'): get_positive_predictive_value_j,
+    ('npv', 'i'): get_negative_predictive_value_i,
+    ('npv', 'j'): get_negative_predictive_value_j,
+    ('tpr', 'i'): getTPR_i,
+    ('tpr', 'j'): getTPR_j,
+    ('fpr', 'i'): getFPR_i,
+    ('fpr', 'j'): getFPR_j,
+}
+pandas_metrics = {  # computed from the confusion matrices
+    'stat_parity': get_statistical_parity,
+    'acc_equality_diff': get_acc_equality_diff,
+    'disp_impact': get_disparate_impact,
+    'acc_equality_ratio': get_acc_equality_ratio,
+}
+pandas_rate_metrics = {  # computed from (majority rate, minority rate)
+    'equal_opp_diff': get_equal_opp_diff,
+    'pred_equality_diff': get_pred_equality_diff,
+    'pos_pred_parity_diff': get_pos_pred_parity_diff,
+    'neg_pred_parity_diff': get_neg_pred_parity_diff,
+    'equal_opp_ratio': get_equal_opp_ratio,
+    'pred_equality_ratio': get_pred_equality_ratio,
+    'pos_pred_parity_ratio': get_pos_pred_parity_ratio,
+    'neg_pred_parity_ratio': get_neg_pred_parity_ratio,
+}
+
+
+# The factories below create the compute functions of the stages, so that each one captures its own parameters
+def _rate_index(rate, group, n_cols):
+    return lambda chunk: get_rate_index(chunk, rate, group, n_cols)
+
+
+def _gather(table):
+    return lambda idx: table.ravel().take(idx)
+
+
+def _identity():
+    return lambda values: values
+
+
+def _cells_sum(groups, cells):
+    return lambda chunk: sum(get_cells_sum(chunk, group, cells, np.intp) for group in groups)
+
+
+def _divide(denominator):
+    return lambda key: key / denominator
+
+
+# geometric mean of the true positive and true negative rates, over both groups
+def _g_mean():
+    return _ignore_division_errors(lambda tp, tn, positives, negatives: (tp * tn / positives / negatives) ** 0.5)
+
+
+def _difference():
+    return lambda j_rate, i_rate: j_rate - i_rate
+
+
+def _ratio():
+    return _ignore_division_errors(lambda j_rate, i_rate: j_rate / i_rate)
+
+
+# x / 0 is expected for the ratio metrics (it is inf or NaN, like in the pandas functions)
+def _ignore_division_errors(compute):
+    def ignoring(*args):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return compute(*args)
+
+    return ignoring
+
+
+def _fused(metrics, sample_size):
+    return lambda chunk: get_fused_metrics(chunk.to_numpy(), metrics, sample_size)
+
+
+def _fused_values(m):
+    return lambda fused: fused[m]
+
+
+def _index_keys(sample_size):
+    return lambda codes, gr_key, ir_key: get_index_keys(codes, gr_key, ir_key, sample_size)
+
+
+def _argsort():
+    return lambda values: np.argsort(values, kind='stable')
+
+
+def _take():
+    return lambda values, order: values.take(order)
+
+
+# ids of the rows of the chunk, i.e. their positions in the dataset
+def _row_ids():
+    return lambda chunk, order: chunk.index.to_numpy().take(order)
+
+
+def _rate_fraction(rate, group, sample_size, part):
+    return lambda chunk: get_rate_fraction(chunk, rate, group, sample_size)[part]
+
+
+def _undefined_mask(keys):
+    return lambda *states: get_undefined_mask(dict(zip(keys, states)))
+
+
+def _category_counts(sample_size):
+    n_categories = len(ratio_categories)
+
+    def count(gr_key, ir_key, *categories):
+        counts = np.zeros((len(categories), 2, sample_size + 1, n_categories), dtype=np.int64)
+        for m, metric_categories in enumerate(categories):
+            for r, key in enumerate([gr_key, ir_key]):
+                counts[m, r] = np.bincount(
+                    key * n_categories + metric_categories, minlength=(sample_size + 1) * n_categories
+                ).reshape(-1, n_categories)
+        return counts
+
+    return count
+
+
+# Stages of the metric calculations, built from the metric definitions (`rate_cells`, `diff_metric_rates`,
+# `ratio_metric_rates`): group sums -> rates -> difference and ratio metrics, plus the undefined-values bitmask
+# and the categories of the ratio metrics, which do not depend on the backend
+def get_metric_stages(sample_size: int, backend='lut', output_format='float64', exact=False, index=False):
+    table = get_rate_table(sample_size)
+    state_table = get_rate_state_table(sample_size)
+    n_cols = table.shape[1]
+    stages = list()
+
+    # group sums, as indices into the rate tables
+    for rate in rate_cells:
+        for group in ['i', 'j']:
+            stages.append(Stage(f'{group}_{rate}_idx', _rate_index(rate, group, n_cols), dtype=np.int32))
+            stages.append(Stage(f'{group}_{rate}_state', _gather(state_table), [f'{group}_{rate}_idx'], np.uint8))
+
+    # the same indices, saved for the composite metrics (see composites.py)
+    for rate in composite_rates:
+        for group in ['i', 'j']:
+            stages.append(
+                Stage(
+                    f'{group}_{rate}_frac',
+                    _identity(),
+                    [f'{group}_{rate}_idx'],
+                    get_rate_index_dtype(sample_size),
+                    output=f'{group}_{rate}.frac.bin',
+                )
+            )
+
+    stages.append(Stage('gr_key', _cells_sum(['j'], ('tp', 'fp', 'tn', 'fn')), dtype=np.intp))
+    stages.append(Stage('ir_key', _cells_sum(['i', 'j'], ('tp', 'fn')), dtype=np.intp))
+    # integer keys of the strata, for exact matching and grouping (see strata.py)
+    key_dtype = get_stratum_key_dtype(sample_size)
+    for ratio in ['gr', 'ir']:
+        stages.append(Stage(f'{ratio}_stratum', _identity(), [f'{ratio}_key'], key_dtype, output=f'{ratio}.key.bin'))
+
+    # ratios
+    if backend != 'pandas':
+        stages.append(Stage('gr', _divide(sample_size), ['gr_key'], output='gr.bin'))
+        stages.append(Stage('ir', _divide(sample_size), ['ir_key'], output='ir.bin'))
+    else:
+        stages.append(Stage('gr', get_group_ratios, output='gr.bin'))
+        stages.append(Stage('ir', get_imbalance_ratios, output='ir.bin'))
+
+    # performance measures of the classifier, over both groups
+    stages.append(Stage('correct_key', _cells_sum(['i', 'j'], ('tp', 'tn')), dtype=np.intp))
+    stages.append(Stage('accuracy', _divide(sample_size), ['correct_key'], output='accuracy.bin'))
+    for cell in ['tp', 'tn']:
+        stages.append(Stage(f'{cell}_key', _cells_sum(['i', 'j'], (cell,)), dtype=np.intp))
+    stages.append(Stage('negatives_key', _cells_sum(['i', 'j'], ('tn', 'fp')), dtype=np.intp))
+    stages.append(Stage('g_mean', _g_mean(), ['tp_key', 'tn_key', 'ir_key', 'negatives_key'], output='g_mean.bin'))
+
+    # rates
+    for rate in rate_cells:
+        for group in ['i', 'j']:
+            output = f'{group}_{rate}.bin' if rate in rate_files else None
+            if backend != 'pandas':
+                stages.append(Stage(f'{group}_{rate}', _gather(table), [f'{group}_{rate}_idx'], output=output))
+            elif (rate, group) in pandas_rates:
+                stages.append(Stage(f'{group}_{rate}', pandas_rates[(rate, group)], output=output))
+
+            if exact:
+                for part, part_name in enumerate(['num', 'den']):
+                    stages.append(
+                        Stage(
+                            f'{group}_{rate}_{part_name}',
+                            _rate_fraction(rate, group, sample_size, part),
+                            dtype=get_fraction_dtype(sample_size),
+                            output=f'{group}_{rate}_{part_name}.bin',
+                        )
+                    )
+
+    # the fused backend computes all difference and ratio metrics in a single pass over the chunk
+    # (see fused_kernels.py)
+    fused_metrics = list(diff_metric_rates) + list(ratio_metric_rates)
+    if backend == 'fused':
+        fused_dtype = (np.float64, len(fused_metrics))
+        stages.append(Stage('fused', _fused(fused_metrics, sample_size), dtype=fused_dtype))
+
+    # difference metrics
+    # as codes into the dictionary of their values (see value_codes.py), for the 'codes' output and the value index
+    if output_format == 'codes' or index:
+        dictionary = DiffDictionary(sample_size)
+        for rate in set(diff_metric_rates.values()):
+            for group in ['i', 'j']:
+                stages.append(
+                    Stage(f'{group}_{rate}_code', _gather(dictionary.rate_codes), [f'{group}_{rate}_idx'], np.int32)
+                )
+        for metric, rate in diff_metric_rates.items():
+            stages.append(
+                Stage(
+                    f'{metric}_code',
+                    dictionary.encode_rates,
+                    [f'j_{rate}_code', f'i_{rate}_code'],
+                    dictionary.dtype,
+                    output=f'{metric}.codes.bin' if output_format == 'codes' else None,
+                )
+            )
+
+    if output_format != 'codes':
+        for metric, rate in diff_metric_rates.items():
+            if backend == 'fused':
+                compute = _fused_values(fused_metrics.index(metric))
+                stages.append(Stage(metric, compute, ['fused'], output=f'{metric}.bin'))
+            elif backend == 'lut':
+                stages.append(Stage(metric, _difference(), [f'j_{rate}', f'i_{rate}'], output=f'{metric}.bin'))
+            elif metric in pandas_metrics:
+                stages.append(Stage(metric, pandas_metrics[metric], output=f'{metric}.bin'))
+            else:
+                compute = pandas_rate_metrics[metric]
+                stages.append(Stage(metric, compute, [f'j_{rate}', f'i_{rate}'], output=f'{metric}.bin'))
+
+    # ratio metrics, and the category of each value
+    for metric, rate in ratio_metric_rates.items():
+        if backend == 'fused':
+            stages.append(Stage(metric, _fused_values(fused_metrics.index(metric)), ['fused'], output=f'{metric}.bin'))
+        elif backend == 'lut':
+            stages.append(Stage(metric, _ratio(), [f'j_{rate}', f'i_{rate}'], output=f'{metric}.bin'))
+        elif metric in pandas_metrics:
+            stages.append(Stage(metric, pandas_metrics[metric], output=f'{metric}.bin'))
+        else:
+            compute = _ignore_division_errors(pandas_rate_metrics[metric])
+            stages.append(Stage(metric, compute, [f'j_{rate}', f'i_{rate}'], output=f'{metric}.bin'))
+
+        stages.append(
+            Stage(
+                f'{metric}_cat',
+                get_ratio_categories,
+                [f'j_{rate}_state', f'i_{rate}_state'],
+                np.uint8,
+                output=f'{metric}.cat.bin',
+            )
+        )
+
+    stages.append(
+        Stage(
+            'ratio_categories',
+            _category_counts(sample_size),
+            ['gr_key', 'ir_key'] + [f'{metric}_cat' for metric in ratio_metric_rates],
+            np.int64,
+            output='ratio_categories.bin',
+            aggregate=True,
+        )
+    )
+
+    # inverted index from the values to the rows (see value_index.py): the keys and row ids of each chunk,
+    # sorted by key, which value_index.save_value_index merges once all the chunks are done
+    if index:
+        key_dtype = get_index_key_dtype(dictionary, sample_size)
+        for metric in diff_metric_rates:
+            stages.append(
+                Stage(f'{metric}_key', _index_keys(sample_size), [f'{metric}_code', 'gr_key', 'ir_key'], np.int64)
+            )
+            stages.append(Stage(f'{metric}_order', _argsort(), [f'{metric}_key'], np.intp))
+            stages.append(
+                Stage(
+                    f'{metric}_index_keys',
+                    _take(),
+                    [f'{metric}_key', f'{metric}_order'],
+                    key_dtype,
+                    output=f'{metric}.index.runs.keys.bin',
+                )
+            )
+            stages.append(
+                Stage(
+                    f'{metric}_index_ids',
+                    _row_ids(),
+                    ['chunk', f'{metric}_order'],
+                    get_index_id_dtype(sample_size),
+                    output=f'{metric}.index.runs.ids.bin',
+                )
+            )
+
+    # bitmask of the rates with a zero denominator
+    state_keys = [(rate, group) for rate in rate_cells for group in ['i', 'j']]
+    stages.append(
+        Stage(
+            'undefined',
+            _undefined_mask(state_keys),
+            [f'{group}_{rate}_state' for rate, group in state_keys],
+            np.uint16,
+            output='undefined.bin',
+        )
+    )
+
+    return stages
+
+
+# ratio_categories.bin as a data frame: counts of each category, by metric, ratio type and ratio
+def get_ratio_category_counts(counts: np.ndarray, sample_size: int):
+    counts = counts.reshape(len(ratio_metric_rates), 2, sample_size + 1, len(ratio_categories))
+    category_counts = list()
+    for m, metric in enumerate(ratio_metric_rates):
+        for r, ratio_type in enumerate(['gr', 'ir']):
+            df = pd.DataFrame(counts[m, r], columns=ratio_categories)
+            df.insert(0, 'ratio', np.arange(sample_size + 1) / sample_size)
+            df.insert(0, 'ratio_type', ratio_type)
+            df.insert(0, 'metric', metric)
+            category_counts.append(df)
+    return pd.concat(category_counts)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Statistics of the metrics in each stratum
+#
+# mean, variance, skewness and quantiles of every metric, for each GR, IR and (GR, IR)
+
+# In[ ]:
+
+
+import os
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from chunked_io import IOStats
+from manifest import Manifest
+from shards import MERGED_FILE, ShardAggregates
+from strata import get_joint_strata, get_ratio_columns, get_stratum_keys
+from stratum_summary import StratumSummary
+from utils import Timer, composite_metrics, diff_metric_rates, ratio_metric_rates
+
+
+# In[ ]:
+
+
+sample_size = 56
+# quantiles of the finite values of each metric; they are exact, from the counts of the distinct values
+quantiles = [0.05, 0.5, 0.95]
+# 'codes' reads the dictionary-encoded difference metrics, saved by metrics_calculations with `output_format = 'codes'`
+input_format = 'float64'
+# directory of the shards of the dataset computed separately (see shards.py), e.g. shards.get_shards_dir(sample_size):
+# the summaries are then taken from their merged aggregates
+shards_dir = None
+
+calculations_dir = path.join('out', 'calculations', f'n{sample_size}')
+timer_dir = path.join('out', 'time')
+os.makedirs(timer_dir, exist_ok=True)
+
+# only files computed from the same dataset, with their recorded dtype and length, are loaded
+manifest = Manifest(calculations_dir)
+io_stats = IOStats()
+
+metrics = list(diff_metric_rates) + list(ratio_metric_rates) + list(composite_metrics)
+
+
+# In[ ]:
+
+
+# file of each metric, and the function giving its float64 values from a chunk of the file
+def get_metric_file(metric):
+    if input_format == 'codes' and metric in diff_metric_rates:
+        values = np.append(manifest.load('diff_values.bin'), np.nan)
+        return f'{metric}.codes.bin', values.take
+    return f'{metric}.bin', lambda chunk: chunk
+
+
+# (GR, IR) strata (see strata.py), and the GR and IR of each of them
+n_keys = sample_size + 1
+joint_strata = get_joint_strata(sample_size)
+
+
+# Summaries of every metric in each (GR, IR) stratum, in a single chunked pass that reads every file once;
+# those of each GR and IR are merged from them
+def count_summaries(metrics):
+    metric_files = {metric: get_metric_file(metric) for metric in metrics}
+    files = ['gr.key.bin', 'ir.key.bin'] + [fn for fn, _ in metric_files.values()]
+
+    summaries = {metric: StratumSummary(n_keys**2) for metric in metrics}
+    for gr_key, ir_key, *chunks in zip(*(manifest.read_chunks(fn, stats=io_stats) for fn in files)):
+        strata = get_stratum_keys(gr_key, ir_key, sample_size)
+        for (metric, (_, get_values)), chunk in zip(metric_files.items(), chunks):
+            summaries[metric].add(strata, get_values(chunk))
+    return summaries
+
+
+def summarize(metrics):
+    if shards_dir is not None:
+        merged = ShardAggregates.load(path.join(shards_dir, MERGED_FILE))
+        summaries = {metric: merged.summaries[metric] for metric in metrics}
+    else:
+        summaries = count_summaries(metrics)
+    timer.checkpoint("summarize")
+
+    tables = list()
+    for metric, summary in summaries.items():
+        by_ratio = {'gr_ir': summary}
+        by_ratio.update({ratio: summary.marginalize(strata_map, n_keys) for ratio, strata_map in joint_strata.items()})
+        for ratio_type, ratio_summary in by_ratio.items():
+            df = ratio_summary.to_frame(quantiles)
+            ratios = get_ratio_columns(ratio_type, df.index.to_numpy(), sample_size)
+            columns = {'metric': metric, 'ratio_type': ratio_type, **ratios}
+            tables.append(pd.concat([pd.DataFrame(columns, index=df.index), df], axis=1))
+    # in the rows of each GR, IR is left empty, and vice versa
+    return pd.concat(tables)
+
+
+# In[ ]:
+
+
+timer = Timer().start()
+
+statistics = summarize(metrics)
+statistics.to_csv(path.join(calculations_dir, 'metric_statistics.csv'), index=False)
+timer.checkpoint("save metric_statistics.csv")
+
+io_stats.report(timer, 'Metric files')
+timer.reset()
+timer.print()
+timer.to_file(fn='metric_statistics.csv')
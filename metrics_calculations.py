@@ -10,32 +10,46 @@
 # In[ ]:
 
 
-import gc
+import argparse
 import os
 import pickle
 from os import path
 
-import numpy as np
 import pandas as pd
 
-from utils import *  # metrics functions
+from chunked_io import IOStats
+from composites import save_composite_metrics
+from manifest import Manifest
+from metric_graph import get_metric_stages, get_ratio_category_counts
+from scheduler import StageScheduler, parse_memory
+from sets_creation import genset_k_by_range, the_ratio
+from utils import Timer, data_cols, diff_metric_rates
+from value_codes import DiffDictionary
+from value_index import save_value_index
+from zone_maps import get_zone_columns, save_zone_maps
 
 
 # In[ ]:
 
 
-data_cols = [
-    'i_tp',  # minority true positive
-    'i_fp',  # minority false positive
-    'i_tn',  # minority true negative
-    'i_fn',  # minority false negative
-    'j_tp',  # majority true positive
-    'j_fp',  # majority false positive
-    'j_tn',  # majority true negative
-    'j_fn',  # majority false negative
-]
-
 sample_size = 56
+# exact mode additionally stores every per-group rate as an integer (numerator, denominator) pair,
+# so that perfect fairness can be tested exactly instead of on float values
+exact = False
+# 'lut' evaluates every rate with a precomputed lookup table (see rate_tables.py), 'pandas' with the utils functions,
+# 'fused' computes all the metrics in a single loop, compiled with numba if it is installed (see fused_kernels.py)
+backend = 'lut'
+# 'float64' writes raw metric values, 'codes' writes the difference metrics as codes into a shared dictionary
+# of all their possible values (see value_codes.py), which takes 2-4 bytes per row instead of 8
+output_format = 'float64'
+assert backend == 'lut' or output_format == 'float64', 'Dictionary-encoded output requires the lookup-table backend.'
+# index builds an inverted index from the values of the difference metrics to the rows of the dataset,
+# for each GR and IR (see value_index.py); it takes 16 bytes per row and metric: the sorted runs of the chunks,
+# and the index merged from them
+index = False
+# virtual mode computes the confusion matrices of each chunk from their indices in the dataset
+# (see `genset_k_by_range` in sets_creation.py), so the dataset file does not have to be created or loaded
+virtual = False
 
 calculations_dir = path.join('out', 'calculations', f'n{sample_size}')
 timer_dir = path.join('out', 'time')
@@ -45,225 +59,97 @@ os.makedirs(timer_dir, exist_ok=True)
 dataset_path = path.join('out', f'Set(08,{sample_size}).bin')
 
 
-# In[ ]:
-
-
-with open(dataset_path, "rb") as f:
-    df = pd.DataFrame(pickle.load(f), columns=data_cols)
-
-df.head()
-
-
-# # Part 1: ratios and basic metrics
-#
-# For each row, its group and imbalance ratio is calculated. Then, metrics that derive directly from these ratios are calculated.
-
-# In[ ]:
-
-
-timer = Timer().start()
-
-# Calculate group ratios
-with open(path.join(calculations_dir, "gr.bin"), "wb+") as f:
-    get_group_ratios(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('Calculate group ratios')
-
-# Calculate imbalance ratios
-with open(path.join(calculations_dir, "ir.bin"), "wb+") as f:
-    get_imbalance_ratios(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('Calculate imbalance ratios')
-
-# ##########################
-
-with open(path.join(calculations_dir, "i_ppv.bin"), "wb+") as f:
-    get_positive_predictive_value_i(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_positive_predictive_value_i')
-
-with open(path.join(calculations_dir, "j_ppv.bin"), "wb+") as f:
-    get_positive_predictive_value_j(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_positive_predictive_value_j')
-
-with open(path.join(calculations_dir, "i_npv.bin"), "wb+") as f:
-    get_negative_predictive_value_i(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_negative_predictive_value_i')
-
-with open(path.join(calculations_dir, "j_npv.bin"), "wb+") as f:
-    get_negative_predictive_value_j(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_negative_predictive_value_j')
-
-# ##########################
-
-with open(path.join(calculations_dir, "stat_parity.bin"), "wb+") as f:
-    get_statistical_parity(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_statistical_parity')
-
-# with open(path.join(calculations_dir, "disp_impact.bin"), "wb+") as f:
-#     get_disparate_impact(df).to_numpy().tofile(f)
-# timer.checkpoint('get_disparate_impact')
-
-# with open(path.join(calculations_dir, "acc_equality_ratio.bin"), "wb+") as f:
-#     get_acc_equality_ratio(df).to_numpy().tofile(f)
-# timer.checkpoint('get_acc_equality_ratio')
-
-with open(path.join(calculations_dir, "acc_equality_diff.bin"), "wb+") as f:
-    get_acc_equality_diff(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('get_acc_equality_diff')
-
-# calculate metrics
-with open(path.join(calculations_dir, "i_tpr.bin"), "wb+") as f:
-    getTPR_i(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('getTPR_i')
-
-with open(path.join(calculations_dir, "j_tpr.bin"), "wb+") as f:
-    getTPR_j(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('getTPR_j')
-
-with open(path.join(calculations_dir, "i_fpr.bin"), "wb+") as f:
-    getFPR_i(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('getFPR_i')
-
-with open(path.join(calculations_dir, "j_fpr.bin"), "wb+") as f:
-    getFPR_j(df).to_numpy().tofile(f)
-gc.collect()
-timer.checkpoint('getFPR_j')
-
-# ##########################
-
-timer.reset()
-timer.print()
-
-# Free the memory
-del df
-gc.collect()
-gc.get_stats()
-
-
-# # Part 2: Get additional calculations
-#
-# Calculations that are based on the previous ones. Some files from the previous part are used here, and new ones are created.
-
-# In[ ]:
-
-
-timer.start()
-
-with open(path.join(calculations_dir, "i_tpr.bin"), "rb") as f:
-    i_tpr = pd.DataFrame(np.fromfile(f), columns=["i_tpr"])
-timer.checkpoint('i_tpr')
-
-with open(path.join(calculations_dir, "j_tpr.bin"), "rb") as f:
-    j_tpr = pd.DataFrame(np.fromfile(f), columns=["j_tpr"])
-timer.checkpoint('j_tpr')
-
-# with open(path.join(calculations_dir, "equal_opp_ratio.bin"), "wb+") as f:
-#     get_equal_opp_ratio(j_tpr['j_tpr'], i_tpr['i_tpr']).to_numpy().tofile(f)
-# timer.checkpoint('get_equal_opp_ratio')
+def get_virtual_chunk(start, stop):
+    X = genset_k_by_range(8, sample_size, start, stop)
+    return pd.DataFrame(X, columns=data_cols, index=pd.RangeIndex(start, stop))
 
-with open(path.join(calculations_dir, "equal_opp_diff.bin"), "wb+") as f:
-    get_equal_opp_diff(j_tpr['j_tpr'], i_tpr['i_tpr']).to_numpy().tofile(f)
-timer.checkpoint('get_equal_opp_diff')
 
-timer.reset()
-timer.print()
-
-del j_tpr
-del i_tpr
-gc.collect()
-
-
-# In[ ]:
-
-
-timer.start()
-
-with open(path.join(calculations_dir, "i_fpr.bin"), "rb") as f:
-    i_fpr = pd.DataFrame(np.fromfile(f), columns=["i_fpr"])
-timer.checkpoint('i_fpr')
-
-with open(path.join(calculations_dir, "j_fpr.bin"), "rb") as f:
-    j_fpr = pd.DataFrame(np.fromfile(f), columns=["j_fpr"])
-timer.checkpoint('j_fpr')
-
-# with open(path.join(calculations_dir, "pred_equality_ratio.bin"), "wb+") as f:
-#     get_pred_equality_ratio(j_fpr['j_fpr'], i_fpr['i_fpr']).to_numpy().tofile(f)
-
-with open(path.join(calculations_dir, "pred_equality_diff.bin"), "wb+") as f:
-    get_pred_equality_diff(j_fpr['j_fpr'], i_fpr['i_fpr']).to_numpy().tofile(f)
-timer.checkpoint('get_pred_equality_diff')
-
-timer.reset()
-timer.print()
-
-del j_fpr
-del i_fpr
-gc.collect()
+# files that are up to date with the dataset and the metric definitions are not recomputed
+if virtual:
+    virtual_dataset = (f'Set(08,{sample_size})', get_virtual_chunk)
+    manifest = Manifest(calculations_dir, virtual_dataset=virtual_dataset, sample_size=sample_size)
+else:
+    manifest = Manifest(calculations_dir, dataset_path, sample_size=sample_size)
 
 
 # In[ ]:
 
 
-timer.start()
-
-with open(path.join(calculations_dir, "i_ppv.bin"), "rb") as f:
-    i_ppv = pd.DataFrame(np.fromfile(f), columns=["i_ppv"])
-timer.checkpoint('i_ppv')
-
-with open(path.join(calculations_dir, "j_ppv.bin"), "rb") as f:
-    j_ppv = pd.DataFrame(np.fromfile(f), columns=["j_ppv"])
-timer.checkpoint('j_ppv')
+# the stages of the calculations (see metric_graph.py) run chunk by chunk, concurrently;
+# `--max-memory 8G` bounds the chunk size so that the intermediate results fit in the given memory; the memory
+# per row is estimated, not measured, so the budget is approximate (an upper bound, see scheduler.TEMP_BYTES_PER_ROW)
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--max-memory',
+    type=parse_memory,
+    default=None,
+    help='approximate memory budget, e.g. 8G: the chunk size is chosen from an estimate of the memory per row',
+)
+parser.add_argument('--workers', type=int, default=None)
+args, _ = parser.parse_known_args()
 
-# with open(path.join(calculations_dir, "pos_pred_parity_ratio.bin"), "wb+") as f:
-#     get_pos_pred_parity_ratio(j_ppv['j_ppv'], i_ppv['i_ppv']).to_numpy().tofile(f)
-
-with open(path.join(calculations_dir, "pos_pred_parity_diff.bin"), "wb+") as f:
-    get_pos_pred_parity_diff(j_ppv['j_ppv'], i_ppv['i_ppv']).to_numpy().tofile(f)
-timer.checkpoint('get_pos_pred_parity_diff')
+timer = Timer().start()
 
-timer.reset()
-timer.print()
+if output_format == 'codes':
+    dictionary = DiffDictionary(sample_size)
+    manifest.save("diff_values.bin", lambda: dictionary.values)
 
-del j_ppv
-del i_ppv
-gc.collect()
+stages = get_metric_stages(sample_size, backend, output_format, exact, index)
+scheduler = StageScheduler(stages, manifest, args.workers)
+timer.checkpoint('Build stages')
 
 
 # In[ ]:
 
 
-timer.start()
-
-with open(path.join(calculations_dir, "i_npv.bin"), "rb") as f:
-    i_npv = pd.DataFrame(np.fromfile(f), columns=["i_npv"])
-timer.checkpoint('i_npv')
-
-with open(path.join(calculations_dir, "j_npv.bin"), "rb") as f:
-    j_npv = pd.DataFrame(np.fromfile(f), columns=["j_npv"])
-timer.checkpoint('j_npv')
-
-with open(path.join(calculations_dir, "neg_pred_parity_ratio.bin"), "wb+") as f:
-    get_neg_pred_parity_ratio(j_npv['j_npv'], i_npv['i_npv']).to_numpy().tofile(f)
-timer.checkpoint('get_neg_pred_parity_ratio')
-
-with open(path.join(calculations_dir, "neg_pred_parity_diff.bin"), "wb+") as f:
-    get_neg_pred_parity_diff(j_npv['j_npv'], i_npv['i_npv']).to_numpy().tofile(f)
-timer.checkpoint('get_neg_pred_parity_diff')
+if scheduler.needed and virtual:
+    # each chunk, and the temporary arrays to compute it, take about 40 bytes per row
+    chunk_rows = scheduler.get_chunk_rows(args.max_memory, source_row_bytes=40)
+    scheduler.run(get_virtual_chunk, the_ratio(8, sample_size), chunk_rows)
+elif scheduler.needed:
+    with open(dataset_path, "rb") as f:
+        df = pd.DataFrame(pickle.load(f), columns=data_cols)
+    timer.checkpoint('Load dataset')
+
+    chunk_rows = scheduler.get_chunk_rows(args.max_memory)
+    scheduler.run(lambda start, stop: df.iloc[start:stop], len(df), chunk_rows)
+    del df
+
+if scheduler.needed:
+    timer.checkpoint(f'Run {len(scheduler.needed)} stages in chunks of {chunk_rows} rows')
+
+    for name, seconds in scheduler.durations.items():
+        if name in scheduler.needed:
+            timer.record(name, seconds)
+    scheduler.io_stats.report(timer, 'Outputs')
+
+    critical_path, critical_seconds = scheduler.get_critical_path()
+    print(f'Critical path ({critical_seconds:.2f} s): {" -> ".join(critical_path)}')
+
+# Composite metrics (e.g. equalized odds), from the per-group rate indices saved above
+composites_io_stats = IOStats()
+save_composite_metrics(manifest, sample_size, stats=composites_io_stats)
+composites_io_stats.report(timer, 'Composite metrics')
+timer.checkpoint('save_composite_metrics')
+
+# Inverted indexes of the difference metrics, merged from the sorted runs of the chunks (see value_index.py)
+if index:
+    index_io_stats = IOStats()
+    for metric in diff_metric_rates:
+        save_value_index(manifest, metric, stats=index_io_stats)
+    index_io_stats.report(timer, 'Value indexes')
+    timer.checkpoint('save_value_index')
+
+# Zone maps of every column, for queries that skip the rows that cannot match (see zone_maps.py)
+zone_maps_io_stats = IOStats()
+save_zone_maps(manifest, get_zone_columns(manifest), stats=zone_maps_io_stats)
+zone_maps_io_stats.report(timer, 'Zone maps')
+timer.checkpoint('save_zone_maps')
+
+# Ratio metrics: counts of each category of values (see `ratio_categories`) for each GR and IR
+category_counts = get_ratio_category_counts(manifest.load("ratio_categories.bin"), sample_size)
+category_counts.to_csv(path.join(calculations_dir, 'ratio_categories.csv'), index=False)
 
 timer.reset()
 timer.print()
-
-del j_npv
-del i_npv
-gc.collect()
-
 timer.to_file(fn='metrics_calculations.csv')
@@ -16,7 +16,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from utils import Timer
+from chunked_io import DEFAULT_CHUNK_ROWS, IOStats, read_views
+from epsilon_curves import CodeAxis, EpsilonCurves, Float16Axis, FractionAxis
+from manifest import Manifest
+from shards import MERGED_FILE, ShardAggregates
+from strata import get_joint_strata, get_ratio_columns, get_stratum_keys
+from utils import Timer, diff_metric_rates, get_undefined_bit, rate_cells
 
 warnings.filterwarnings('ignore')
 plt.style.use('default')
@@ -38,8 +43,19 @@ plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 
 
 sample_size = 56
-# setting epsilon to another (small non-negative) value allows to calculate the probability of being epsilon-close to perfect fairness
-epsilon = 0
+# probabilities of being epsilon-close to perfect fairness (|diff| < epsilon, or diff == 0 for 0) are saved for each
+# of these small non-negative values; they are all computed from the same per-stratum counts of |diff|
+epsilons = [0]
+# epsilons of the probability of being epsilon-close to perfect fairness over the whole dataset, plotted as a curve
+curve_epsilons = np.round(np.linspace(0, 0.2, 201), 6)
+# exact mode tests perfect fairness on the rate fractions saved by metrics_calculations (with `exact = True`),
+# instead of on the float16-cast metric values
+exact = False
+# 'codes' reads the dictionary-encoded metric files, saved by metrics_calculations with `output_format = 'codes'`
+input_format = 'float64'
+# directory of the shards of the dataset computed separately (see shards.py), e.g. shards.get_shards_dir(sample_size):
+# the curves and counts are then taken from their merged aggregates (float16 |diff| only)
+shards_dir = None
 
 calculations_dir = path.join('out', 'calculations', f'n{sample_size}')
 timer_dir = path.join('out', 'time')
@@ -47,6 +63,9 @@ os.makedirs(calculations_dir, exist_ok=True)
 os.makedirs(timer_dir, exist_ok=True)
 dataset_path = path.join('..', 'fairness-data-generator', 'out', f'Set(08,{sample_size}).bin')
 
+# only files computed from the same dataset, with their recorded dtype and length, are loaded
+manifest = Manifest(calculations_dir)
+
 
 # In[ ]:
 
@@ -60,50 +79,172 @@ diff_metrics = {  # { file: metric name }
     'neg_pred_parity_diff.bin': 'Negative predictive parity difference',
     'pred_equality_diff.bin': 'Predictive equality difference',
 }
+# composite metrics (see utils.composite_metrics), perfectly fair at 0 too; their results are saved separately
+composite_metrics = {
+    'equalized_odds.bin': 'Equalized odds',
+    'cond_use_acc_equality.bin': 'Conditional use accuracy equality',
+    'treatment_equality.bin': 'Treatment equality',
+    'stereotypical_bias.bin': 'Stereotypical bias',
+}
 
 
 # In[ ]:
 
 
-def calculate_ppf_diff(df, metrics, ratio_type, epsilon=0):
-    pf_probs, nan_probs = {}, {}
+# slices of the files are read on a background thread while the previous one is counted
+io_stats = IOStats()
+
+
+# Files of each metric, and the axis of its |diff| values (see epsilon_curves.py)
+def get_float_axis(metric_file):
+    return [metric_file], Float16Axis()
+
+
+def get_exact_axis(metric_file):
+    rate = diff_metric_rates[metric_file.replace('.bin', '')]
+    return [f'{group}_{rate}_{part}.bin' for group in ['j', 'i'] for part in ['num', 'den']], FractionAxis(sample_size)
+
+
+def get_code_axis(metric_file):
+    return [metric_file.replace('.bin', '.codes.bin')], CodeAxis(manifest.load('diff_values.bin'))
+
 
-    if epsilon == 0:
-        compute_diff_prob = lambda df: np.sum(df['diff'] == 0) / len(df)
+def get_axis(metric_file):
+    # exact and dictionary-encoded files exist for the difference metrics only
+    is_diff_metric = metric_file.replace('.bin', '') in diff_metric_rates
+    if exact and is_diff_metric:
+        return get_exact_axis(metric_file)
+    if input_format == 'codes' and is_diff_metric:
+        return get_code_axis(metric_file)
+    return get_float_axis(metric_file)
+
+
+# (GR, IR) strata (see strata.py), and the GR and IR of each of them
+n_keys = sample_size + 1
+joint_strata = get_joint_strata(sample_size)
+
+
+# Cumulative histograms of |diff| of every metric in each (GR, IR) stratum, and counts of the undefined bitmasks
+# (undefined.bin) for each GR and IR, in a single chunked pass over memory maps of the files. The metrics of a chunk
+# are read and counted one by one (the next one is read while one is counted, see chunked_io.read_views),
+# so a chunk of two metrics (and of the keys) is in memory at a time, whatever the number of metrics.
+def count_joint_curves(metrics):
+    axes = {metric_file: get_axis(metric_file) for metric_file in metrics}
+    key_files = ['gr.key.bin', 'ir.key.bin', 'undefined.bin']
+    files = key_files + [fn for metric_files, _ in axes.values() for fn in metric_files]
+    views = {fn: manifest.view(fn) for fn in files}
+    starts = range(0, len(views['gr.key.bin']), DEFAULT_CHUNK_ROWS)
+    chunks = read_views(
+        ((views[fn], slice(start, start + DEFAULT_CHUNK_ROWS)) for start in starts for fn in files), io_stats
+    )
+
+    n_masks = 1 << (2 * len(rate_cells))
+    joint_curves = {metric_file: EpsilonCurves(axis, n_keys**2) for metric_file, (_, axis) in axes.items()}
+    mask_counts = {'gr': 0, 'ir': 0}
+    for _ in starts:
+        gr_key, ir_key, mask = (next(chunks) for _ in key_files)
+        strata = get_stratum_keys(gr_key, ir_key, sample_size)
+        for metric_file, (metric_files, axis) in axes.items():
+            ranks, defined = axis.get_ranks(*(next(chunks) for _ in metric_files))
+            joint_curves[metric_file].add(strata, ranks, defined)
+
+        for ratio_type, ratio_keys in [('gr', gr_key), ('ir', ir_key)]:
+            mask_counts[ratio_type] += np.bincount(
+                ratio_keys.astype(np.intp) * n_masks + mask, minlength=n_keys * n_masks
+            ).reshape(-1, n_masks)
+    return joint_curves, mask_counts
+
+
+# The joint curves and counts, counted or merged from the shards; the curves of each GR and IR are summed from those
+# of the (GR, IR) strata
+def count_curves(metrics):
+    if shards_dir is not None:
+        merged = ShardAggregates.load(path.join(shards_dir, MERGED_FILE))
+        joint_curves = {metric_file: merged.curves[metric_file] for metric_file in metrics}
+        mask_counts = merged.mask_counts
     else:
-        compute_diff_prob = lambda df: np.sum(np.abs(df['diff']) < epsilon) / len(df)
+        joint_curves, mask_counts = count_joint_curves(metrics)
+
+    curves = {'gr_ir': joint_curves}
+    for ratio_type, strata_map in joint_strata.items():
+        curves[ratio_type] = {
+            metric_file: metric_curves.marginalize(strata_map, n_keys)
+            for metric_file, metric_curves in joint_curves.items()
+        }
+    timer.checkpoint("count_curves")
+    return curves, mask_counts
+
+
+# Probabilities of epsilon-close to perfect fairness, for each epsilon, and of NaN in each stratum of `ratio_type`,
+# from the curves of `count_curves`
+def calculate_ppf_diff(curves, metrics, ratio_type, epsilons=(0,), name=''):
+    pf_probs, nan_probs = {epsilon: {} for epsilon in epsilons}, {}
 
     for metric_file, metric_name in metrics.items():
-        with open(path.join(calculations_dir, metric_file), 'rb') as f:
-            df = pd.concat([df, pd.DataFrame(np.fromfile(f).astype(np.float16), columns=['diff'])], axis=1)
+        metric_curves = curves[metric_file]
+        # strata without any rows are left out
+        strata = np.flatnonzero(metric_curves.totals)
+        totals, defined = metric_curves.totals[strata], metric_curves.get_defined()[strata]
+        close = metric_curves.get_close(epsilons)[strata]
 
-        pf_bygroup = list()
-        nans_bygroup = list()
+        for e, epsilon in enumerate(epsilons):
+            # strata where the metric is never defined have no probability of perfect fairness
+            pf_probs[epsilon][metric_name] = np.where(defined > 0, close[:, e] / totals, np.nan)
+        nan_probs[metric_name] = (totals - defined) / totals
 
-        for gn, group in df.groupby(ratio_type):
-            if group['diff'].isna().all():
-                pf_bygroup.append([gn, np.nan])
-            else:
-                pf_bygroup.append([gn, compute_diff_prob(group)])
-            nans_bygroup.append([gn, group['diff'].isna().sum() / group.shape[0]])
+    ratios = get_ratio_columns(ratio_type, strata, sample_size)
+    for epsilon in epsilons:
+        pf_df = pd.DataFrame(pf_probs[epsilon]).assign(**ratios).reset_index()
+        pf_df.to_csv(path.join(calculations_dir, f'perfect_fairness{name}_{ratio_type}_eps{epsilon}.csv'), index=False)
 
-        pf_bygroup = pd.DataFrame(pf_bygroup, columns=[ratio_type, 'diff'])
-        pf_probs[metric_name] = pf_bygroup['diff']
+    nan_df = pd.DataFrame(nan_probs).assign(**ratios).reset_index()
+    nan_df.to_csv(path.join(calculations_dir, f'nans{name}_{ratio_type}.csv'), index=False)
 
-        nans_bygroup = pd.DataFrame(nans_bygroup, columns=[ratio_type, 'diff'])
-        nan_probs[metric_name] = nans_bygroup['diff']
 
-        # the dataframe (first col) can be reused for the next metric
-        df.drop('diff', axis=1, inplace=True)
-        timer.checkpoint(f"calculate_ppf_diff {metric_name} ε={epsilon}")
+# Probability of being epsilon-close to perfect fairness over the whole dataset, for each of the `epsilons`
+def calculate_ppf_curve(curves, metrics, epsilons, name=''):
+    probs = {'epsilon': epsilons}
+    for metric_file, metric_name in metrics.items():
+        metric_curves = curves[metric_file]
+        probs[metric_name] = metric_curves.get_close(epsilons).sum(axis=0) / metric_curves.totals.sum()
+
+    pd.DataFrame(probs).to_csv(path.join(calculations_dir, f'perfect_fairness{name}_curve.csv'), index=False)
+
+
+# In[ ]:
 
-    pf_probs[ratio_type] = pf_bygroup[ratio_type]
-    pf_df = pd.DataFrame(pf_probs).reset_index()
-    pf_df.to_csv(path.join(calculations_dir, f'perfect_fairness_{ratio_type}_eps{epsilon}.csv'), index=False)
 
-    nan_probs[ratio_type] = nans_bygroup[ratio_type]
-    nan_df = pd.DataFrame(nan_probs).reset_index()
-    nan_df.to_csv(path.join(calculations_dir, f'nans_{ratio_type}.csv'), index=False)
+# Probability of NaN, split by its cause (zero denominator in the minority group, majority group, or both),
+# from the counts of the bitmasks saved by metrics_calculations (undefined.bin) in each stratum
+def calculate_nan_causes(mask_counts, metrics, ratio_type):
+    n_masks = mask_counts.shape[1]
+    totals = mask_counts.sum(axis=1)
+
+    # strata without any rows are left out
+    groups = np.flatnonzero(totals)
+    counts, totals = mask_counts[groups], totals[groups]
+
+    masks = np.arange(n_masks)
+    causes = list()
+    for metric_file, metric_name in metrics.items():
+        rate = diff_metric_rates[metric_file.replace('.bin', '')]
+        i_undefined = (masks & get_undefined_bit(rate, 'i')) > 0
+        j_undefined = (masks & get_undefined_bit(rate, 'j')) > 0
+
+        causes.append(
+            pd.DataFrame(
+                {
+                    ratio_type: groups / sample_size,
+                    'metric': metric_name,
+                    'nan': counts[:, i_undefined | j_undefined].sum(axis=1) / totals,
+                    'minority': counts[:, i_undefined & ~j_undefined].sum(axis=1) / totals,
+                    'majority': counts[:, ~i_undefined & j_undefined].sum(axis=1) / totals,
+                    'both': counts[:, i_undefined & j_undefined].sum(axis=1) / totals,
+                }
+            )
+        )
+
+    pd.concat(causes).to_csv(path.join(calculations_dir, f'nan_causes_{ratio_type}.csv'), index=False)
 
 
 # In[ ]:
@@ -111,17 +252,25 @@ def calculate_ppf_diff(df, metrics, ratio_type, epsilon=0):
 
 timer = Timer().start()
 
+# one pass over the keys of the strata (see strata.py) and the files of all the metrics
+curves, mask_counts = count_curves({**diff_metrics, **composite_metrics})
 for ratio in ['ir', 'gr']:
     print(ratio)
-    try:
-        with open(path.join(calculations_dir, f'{ratio}.bin'), 'rb') as f:
-            df = pd.DataFrame(np.fromfile(f).astype(np.float16), columns=[ratio])
-        timer.checkpoint(f"load {ratio} file")
-        calculate_ppf_diff(df, diff_metrics, ratio, epsilon)
-    finally:
-        del df
-
-# del df
+    calculate_ppf_diff(curves[ratio], diff_metrics, ratio, epsilons)
+    calculate_ppf_diff(curves[ratio], composite_metrics, ratio, epsilons, name='_composite')
+    calculate_nan_causes(mask_counts[ratio], diff_metrics, ratio)
+    timer.checkpoint(f"save {ratio} results")
+
+# surfaces over the (GR, IR) strata
+calculate_ppf_diff(curves['gr_ir'], diff_metrics, 'gr_ir', epsilons)
+calculate_ppf_diff(curves['gr_ir'], composite_metrics, 'gr_ir', epsilons, name='_composite')
+timer.checkpoint("save gr_ir results")
+
+calculate_ppf_curve(curves['gr'], diff_metrics, curve_epsilons)
+calculate_ppf_curve(curves['gr'], composite_metrics, curve_epsilons, name='_composite')
+timer.checkpoint("save curves")
+
+io_stats.report(timer, 'Metric files')
 timer.reset()
 timer.print()
 
@@ -214,6 +363,84 @@ for ratio_type in ratio_types:
 timer.reset()
 
 
+# ### Probability of epsilon-close to perfect fairness, as a function of epsilon
+
+# In[ ]:
+
+
+def plot_ppf_curve(df, color_mapping):
+    fig, ax = plt.subplots(figsize=(9, 8))
+    for col in color_mapping.keys():
+        label = col.replace('difference', '')
+        ax.plot(df['epsilon'], df[col], label=label, alpha=0.5, color=color_mapping[col]['color'])
+
+    ax.set_ylim(0, 1.0)
+    ax.set_xlabel('ε')
+    ax.set_ylabel('Probability of |difference| < ε')
+    ax.spines[['top', 'right']].set_visible(False)
+    ax.legend()
+    plt.tight_layout()
+    return fig
+
+
+# In[ ]:
+
+
+timer.start()
+
+fig = plot_ppf_curve(pd.read_csv(path.join(calculations_dir, 'perfect_fairness_curve.csv')), diff_metrics_styles)
+fig.savefig(path.join(plots_dir, 'ppf_epsilon_curve.pdf'), dpi=300)
+fig.savefig(path.join(plots_dir, 'ppf_epsilon_curve.svg'), dpi=300)
+timer.checkpoint("plot PPF ε curve")
+
+timer.reset()
+
+
+# ### Probabilities of perfect fairness and of NaN over the (GR, IR) strata
+
+# In[ ]:
+
+
+def plot_gr_ir_heatmaps(df, color_mapping, label):
+    # strata without any rows are not in the file, and are left blank
+    fig, axes = plt.subplots(2, 3, figsize=(15, 9), sharex=True, sharey=True)
+    keys = (df[['gr', 'ir']].to_numpy() * sample_size).round().astype(int)
+    for ax, col in zip(axes.flat, color_mapping.keys()):
+        grid = np.full((sample_size + 1, sample_size + 1), np.nan)
+        grid[keys[:, 1], keys[:, 0]] = df[col]
+        image = ax.imshow(grid, origin='lower', extent=(0, 1, 0, 1), vmin=0, vmax=1, cmap='viridis')
+        ax.set_title(col.replace('difference', ''))
+
+    for ax in axes[-1]:
+        ax.set_xlabel(x_description['gr'])
+    for ax in axes[:, 0]:
+        ax.set_ylabel(x_description['ir'])
+    fig.colorbar(image, ax=axes, label=label)
+    return fig
+
+
+# In[ ]:
+
+
+timer.start()
+
+for eps in epsilons:
+    df = pd.read_csv(path.join(calculations_dir, f'perfect_fairness_gr_ir_eps{eps}.csv'))
+    fig = plot_gr_ir_heatmaps(df, diff_metrics_styles, 'Probability of perfect fairness')
+    fig.savefig(path.join(plots_dir, f'ppf_gr_ir_heatmap_eps{eps}.pdf'), dpi=300)
+    fig.savefig(path.join(plots_dir, f'ppf_gr_ir_heatmap_eps{eps}.svg'), dpi=300)
+    timer.checkpoint(f"plot PPF (GR, IR) ε={eps}")
+
+fig = plot_gr_ir_heatmaps(
+    pd.read_csv(path.join(calculations_dir, 'nans_gr_ir.csv')), diff_metrics_styles, 'Probability of NaN'
+)
+fig.savefig(path.join(plots_dir, 'nan_gr_ir_heatmap.pdf'), dpi=300)
+fig.savefig(path.join(plots_dir, 'nan_gr_ir_heatmap.svg'), dpi=300)
+timer.checkpoint("plot NaN (GR, IR)")
+
+timer.reset()
+
+
 # # Probability of NaN - plotting
 
 # In[ ]:
@@ -0,0 +1,144 @@
+__all__ = [
+    'PROGRESSIVE_CHUNK_ROWS',
+    'ProgressiveRatios',
+    'progressive',
+    'progressive_ppf',
+    'progressive_histograms',
+]
+
+from statistics import NormalDist
+
+import numpy as np
+
+from strata import get_stratum_keys, get_stratum_sizes
+
+# rows of a chunk: the unit of the random sample, so the bounds tighten with the number of chunks read
+PROGRESSIVE_CHUNK_ROWS = 1 << 20
+
+
+# Running estimates of proportions (e.g. of perfect fairness in each stratum) from chunks read in a random order,
+# with confidence bounds. Each chunk adds the numbers of rows of each group (`totals`, e.g. of each stratum) and
+# of rows with each property (`counts`, groups x cells). The estimate is the ratio of the sums; its bound is
+# that of a ratio estimator of a sample of chunks drawn without replacement, so it shrinks to 0 when all the chunks
+# have been read, and the estimates are then exact. The variance of a group is estimated from the chunks it has rows
+# in: until there are two of them, its bound is infinite (the rows of a group can be in a few chunks only, as the
+# dataset is ordered), unless all its rows have been read (with the `group_sizes`, rows of each group in the dataset).
+class ProgressiveRatios:
+    def __init__(self, n_chunks: int, confidence=0.95, group_sizes=None):
+        self.n_chunks = n_chunks
+        self.group_sizes = group_sizes
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.chunks = 0
+        self.rows = 0
+        # sums of y (counts), x (totals), and of their squares and products, over the chunks
+        self.y = self.x = self.yy = self.xx = self.xy = 0
+        # number of chunks with rows of each group
+        self.group_chunks = 0
+
+    def add(self, counts, totals):
+        y, x = np.asarray(counts, dtype=np.float64), np.asarray(totals, dtype=np.float64)[:, np.newaxis]
+        self.y, self.x = self.y + y, self.x + x
+        self.yy, self.xx, self.xy = self.yy + y * y, self.xx + x * x, self.xy + x * y
+        self.group_chunks = self.group_chunks + (x > 0)
+        self.chunks += 1
+        self.rows += int(np.sum(totals))
+        return self
+
+    @property
+    def exact(self):
+        return self.chunks == self.n_chunks
+
+    # groups x cells; NaN for groups without any rows read yet
+    def get_estimates(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.x > 0, self.y / self.x, np.nan)
+
+    # half-widths of the confidence intervals of the estimates: inf for the groups with rows in fewer than two
+    # of the chunks read (including those without rows yet), 0 for those with all their rows read
+    # and once all the chunks have been read
+    def get_bounds(self):
+        k = self.chunks
+        estimates = self.get_estimates()
+        if self.exact:
+            return np.where(np.isnan(estimates), np.nan, 0.0)
+        if k < 2:
+            return np.full(estimates.shape, np.inf)
+        residuals = np.maximum(self.yy - 2 * estimates * self.xy + estimates**2 * self.xx, 0)
+        mean_x = self.x / k
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (1 - k / self.n_chunks) * residuals / (k - 1) / (k * mean_x**2)
+        bounds = np.where(self.group_chunks >= 2, self.z * np.sqrt(variance), np.inf)
+        if self.group_sizes is not None:
+            bounds = np.where(self.x >= np.asarray(self.group_sizes)[:, np.newaxis], 0.0, bounds)
+        return bounds
+
+
+# Reads the files of the manifest side by side, in chunks in a random order, and publishes the running estimates
+# of `count_chunk(*chunks) -> (counts, totals)` after every `batch_chunks` chunks (see ProgressiveRatios).
+# Stops once at least `min_chunks` chunks have been read and the bounds of all the groups are within `precision`
+# (groups without rows in two of the chunks read have infinite bounds, unless all their `group_sizes` rows
+# have been read), or when all the chunks have been read.
+def progressive(
+    manifest,
+    files,
+    count_chunk,
+    precision=None,
+    batch_chunks=8,
+    confidence=0.95,
+    seed=0,
+    chunk_rows=PROGRESSIVE_CHUNK_ROWS,
+    min_chunks=16,
+    group_sizes=None,
+):
+    views = [manifest.view(fn) for fn in files]
+    starts = np.random.default_rng(seed).permutation(np.arange(0, len(views[0]), chunk_rows))
+    ratios = ProgressiveRatios(len(starts), confidence, group_sizes)
+
+    for start in starts:
+        ratios.add(*count_chunk(*(np.asarray(view[start : start + chunk_rows]) for view in views)))
+        if ratios.chunks % batch_chunks == 0 or ratios.exact:
+            yield ratios
+            if precision is not None and ratios.chunks >= min_chunks and np.max(ratios.get_bounds()) <= precision:
+                return
+
+
+# Probabilities of perfect fairness (float16 |diff| == 0, as in perfect_fairness_and_undefined) and of NaN of the
+# metrics, for each GR or IR (`ratio_type`): groups are the ratio keys (see strata.py), and the cells are
+# the probabilities of perfect fairness of the metrics, followed by those of NaN. In strata where a metric is never
+# defined, its probability of perfect fairness is 0 (NaN in the results of perfect_fairness_and_undefined).
+def progressive_ppf(manifest, metric_files, ratio_type: str, sample_size: int, precision=None, **options):
+    def count_chunk(keys, *metric_values):
+        keys = keys.astype(np.intp)
+        counts = [
+            np.bincount(keys[np.abs(values.astype(np.float16)) == 0], minlength=sample_size + 1)
+            for values in metric_values
+        ]
+        counts += [np.bincount(keys[np.isnan(values)], minlength=sample_size + 1) for values in metric_values]
+        return np.stack(counts, axis=1), np.bincount(keys, minlength=sample_size + 1)
+
+    files = [f'{ratio_type}.key.bin', *metric_files]
+    group_sizes = get_stratum_sizes(sample_size).reshape(sample_size + 1, -1).sum(axis=1 if ratio_type == 'gr' else 0)
+    return progressive(manifest, files, count_chunk, precision, group_sizes=group_sizes, **options)
+
+
+# Histograms of a metric in every (GR, IR) stratum, as proportions of the rows of the stratum (as in histograms_plot):
+# groups are the strata (see strata.py), and the cells are the bins, with the given edges or a number of equal bins
+# over [-1, 1], followed by NaN
+def progressive_histograms(manifest, metric_file, sample_size: int, bins=50, precision=None, **options):
+    edges = np.linspace(-1, 1, bins + 1) if np.isscalar(bins) else np.asarray(bins)
+    n_cells = len(edges)  # the bins and NaN
+    n_strata = (sample_size + 1) ** 2
+
+    def count_chunk(gr_key, ir_key, values):
+        strata = get_stratum_keys(gr_key, ir_key, sample_size)
+        # as np.histogram: the last bin includes its right edge, values out of the edges are left out
+        cells = np.minimum(np.searchsorted(edges, values, side='right') - 1, len(edges) - 2)
+        cells[(values < edges[0]) | (values > edges[-1])] = -1
+        cells[np.isnan(values)] = n_cells - 1
+        inside = cells >= 0
+        keys = strata[inside] * n_cells + cells[inside]
+        counts = np.bincount(keys, minlength=n_strata * n_cells).reshape(n_strata, n_cells)
+        return counts, np.bincount(strata, minlength=n_strata)
+
+    files = ['gr.key.bin', 'ir.key.bin', metric_file]
+    return progressive(manifest, files, count_chunk, precision, group_sizes=get_stratum_sizes(sample_size), **options)
@@ -0,0 +1,100 @@
+__all__ = [
+    'get_rate_table',
+    'get_rate_index',
+    'get_rate_index_dtype',
+    'get_quantity_table',
+    'get_rate_lut',
+    'get_diff_metric_lut',
+    'get_ratio_metric_lut',
+    'get_rate_state_table',
+    'get_ratio_categories',
+    'get_undefined_mask',
+]
+
+import numpy as np
+
+from utils import diff_metric_rates, get_cells_sum, get_undefined_bit, rate_cells, ratio_metric_rates
+
+
+# Every per-group rate is a / (a + b) with a, b <= sample size (see `rate_cells`),
+# so all of them share one (n+1)x(n+1) table, with NaN where a + b == 0
+def get_rate_table(sample_size: int):
+    a = np.arange(sample_size + 1, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return a[:, np.newaxis] / (a[:, np.newaxis] + a[np.newaxis, :])
+
+
+# Index of the (a, b) cell of a rate in the flattened tables
+def get_rate_index(df, rate: str, group: str, n_cols: int):
+    a_cells, b_cells = rate_cells[rate]
+    idx = get_cells_sum(df, group, a_cells, np.int32) * n_cols
+    idx += get_cells_sum(df, group, b_cells, np.int32)
+    return idx
+
+
+# The index is saved for the composite metrics (as `<group>_<rate>.frac.bin`), in the smallest type that fits it
+def get_rate_index_dtype(sample_size: int):
+    return np.uint16 if (sample_size + 1) ** 2 <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+# Other per-group quantities of a rate a / (a + b), indexed like the rate table: 'odds' (a / b) and 'total' (a + b)
+def get_quantity_table(quantity: str, sample_size: int):
+    if quantity == 'rate':
+        return get_rate_table(sample_size)
+
+    a = np.arange(sample_size + 1, dtype=np.float64)
+    if quantity == 'odds':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return a[:, np.newaxis] / a[np.newaxis, :]
+    if quantity == 'total':
+        return a[:, np.newaxis] + a[np.newaxis, :]
+    raise ValueError(f'Unknown quantity: {quantity}')
+
+
+def get_rate_lut(df, rate: str, group: str, table: np.ndarray):
+    return table.ravel().take(get_rate_index(df, rate, group, table.shape[1]))
+
+
+# Difference metric (majority - minority): two table gathers and one subtraction
+def get_diff_metric_lut(df, metric: str, table: np.ndarray):
+    rate = diff_metric_rates[metric]
+    return get_rate_lut(df, rate, 'j', table) - get_rate_lut(df, rate, 'i', table)
+
+
+# Ratio metric (majority / minority), with inf for x / 0 and NaN for 0 / 0
+def get_ratio_metric_lut(df, metric: str, table: np.ndarray):
+    rate = ratio_metric_rates[metric]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return get_rate_lut(df, rate, 'j', table) / get_rate_lut(df, rate, 'i', table)
+
+
+# State of a rate a / (a + b): 0 - positive, 1 - zero, 2 - undefined
+def get_rate_state_table(sample_size: int):
+    a = np.arange(sample_size + 1)
+    table = np.broadcast_to(np.where(a > 0, 0, 1)[:, np.newaxis], (sample_size + 1, sample_size + 1)).astype(np.uint8)
+    table[0, 0] = 2
+    return table
+
+
+# Category of j_rate / i_rate (an index into `ratio_categories`), by [state of j_rate, state of i_rate]
+_ratio_category_table = np.array(
+    [
+        [0, 1, 3],
+        [0, 2, 3],
+        [3, 3, 3],
+    ],
+    dtype=np.uint8,
+)
+
+
+def get_ratio_categories(j_state, i_state):
+    return _ratio_category_table.ravel().take(j_state * 3 + i_state)
+
+
+# Bitmask (see `get_undefined_bit`) of the rates with a zero denominator, for each group
+# `states` are the rate states (see `get_rate_state_table`), by (rate, group)
+def get_undefined_mask(states: dict):
+    mask = np.zeros(len(next(iter(states.values()))), dtype=np.uint16)
+    for (rate, group), state in states.items():
+        mask |= (state == 2) * np.uint16(get_undefined_bit(rate, group))
+    return mask
@@ -0,0 +1,206 @@
+__all__ = [
+    'Stage',
+    'StageScheduler',
+    'parse_memory',
+    'get_rss',
+]
+
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import path
+from time import perf_counter
+
+import numpy as np
+
+from chunked_io import ChunkWriter, IOStats
+from manifest import get_definition_hash
+
+# memory for temporary arrays of a running stage (e.g. gather indices), per row. It is not measured for each stage:
+# together with counting every stage's result as alive at once (most are freed as soon as they are used), it gives
+# an upper bound. At n = 28 with a 1 GB budget, the peak RSS of metrics_calculations was 45-60% of the budget
+# with each backend (lut, pandas, fused), 1 to 16 workers, and either virtual or in-memory datasets.
+TEMP_BYTES_PER_ROW = 16
+
+
+# '8G', '512M', '1024' -> bytes
+def parse_memory(value: str):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = value.strip().upper().removesuffix('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+# resident set size of the current process, in bytes (0 if it cannot be read)
+def get_rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# A node of the computation graph. `compute` gets the results of `deps` (for one chunk of rows) as arguments;
+# the stage named 'chunk' is the source, i.e. the chunk of the dataset itself.
+# Results of stages with `output` are appended to that file. Results of `aggregate` stages are summed over all chunks
+# and saved to `output` at the end.
+class Stage:
+    def __init__(self, name: str, compute, deps=('chunk',), dtype=np.float64, output: str = None, aggregate=False):
+        self.name = name
+        self.compute = compute
+        self.deps = tuple(deps)
+        self.dtype = np.dtype(dtype)
+        self.output = output
+        self.aggregate = aggregate
+
+
+# Runs the stages chunk by chunk. Within a chunk, the stages whose dependencies are done run concurrently,
+# and results are freed as soon as all the stages using them are done.
+# Outputs that are up to date in the manifest are not recomputed, nor are the stages only they depend on.
+class StageScheduler:
+    def __init__(self, stages, manifest, workers: int = None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.manifest = manifest
+        self.workers = workers or os.cpu_count()
+        self.durations = {name: 0.0 for name in self.stages}
+        self.results = dict()
+        self.io_stats = IOStats()
+
+        self.definition_hashes = dict()
+        for name in self.stages:
+            self._get_definition_hash(name)
+
+        self.needed = self._get_needed_stages()
+        self.consumers = {name: [s for s in self.needed if name in self.stages[s].deps] for name in self.needed}
+
+    # the hash of a stage covers its compute function and, recursively, the stages it depends on
+    def _get_definition_hash(self, name):
+        if name == 'chunk':
+            return 'chunk'
+        if name not in self.definition_hashes:
+            stage = self.stages[name]
+            hashes = [get_definition_hash(stage.compute)] + [self._get_definition_hash(dep) for dep in stage.deps]
+            self.definition_hashes[name] = hashlib.blake2b(' '.join(hashes).encode(), digest_size=16).hexdigest()
+        return self.definition_hashes[name]
+
+    def _get_needed_stages(self):
+        needed = set()
+        todo = [
+            name
+            for name, stage in self.stages.items()
+            if stage.output is not None and not self.manifest.is_up_to_date(stage.output, self.definition_hashes[name])
+        ]
+        while todo:
+            name = todo.pop()
+            if name != 'chunk' and name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return needed
+
+    # rows per chunk, such that the results of all stages and the temporaries of the running ones
+    # fit in `max_memory` (approximately, see TEMP_BYTES_PER_ROW), on top of the memory already used (`get_rss`);
+    # `source_row_bytes` is the memory taken by the chunk itself, if it is not a part of a dataset already in memory
+    def get_chunk_rows(self, max_memory: int = None, default_rows=1 << 24, source_row_bytes=0):
+        if max_memory is None:
+            return default_rows
+
+        row_bytes = source_row_bytes + sum(self.stages[name].dtype.itemsize for name in self.needed)
+        # outputs of the previous chunk, still being flushed
+        row_bytes += sum(self.stages[name].dtype.itemsize for name in self.needed if self.stages[name].output)
+        row_bytes += self.workers * TEMP_BYTES_PER_ROW
+        available = max_memory - get_rss()
+        if available < row_bytes:
+            raise MemoryError(f'Memory budget of {max_memory} bytes is exceeded by the {get_rss()} bytes already used.')
+        return available // row_bytes
+
+    def _run_stage(self, stage, args):
+        start_t = perf_counter()
+        result = stage.compute(*args)
+        if hasattr(result, 'to_numpy'):
+            result = result.to_numpy()
+        if stage.output is not None and not stage.aggregate:
+            self.writers[stage.name].write(result)
+        return result, perf_counter() - start_t
+
+    def _run_chunk(self, chunk, executor):
+        values = {'chunk': chunk}
+        remaining = {name: len(consumers) for name, consumers in self.consumers.items()}
+        waiting = set(self.needed)
+        running = dict()
+
+        while waiting or running:
+            for name in [n for n in waiting if all(dep in values for dep in self.stages[n].deps)]:
+                stage = self.stages[name]
+                running[executor.submit(self._run_stage, stage, [values[dep] for dep in stage.deps])] = name
+                waiting.remove(name)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                result, duration = future.result()
+                self.durations[name] += duration
+
+                if self.stages[name].aggregate:
+                    self.results[name] = self.results[name] + result if name in self.results else result
+                if remaining[name]:
+                    values[name] = result
+                for dep in self.stages[name].deps:
+                    if dep != 'chunk':
+                        remaining[dep] -= 1
+                        if remaining[dep] == 0:
+                            del values[dep]
+
+    # `get_chunk(start, stop)` returns the rows of the dataset in the given range.
+    # Outputs of a chunk are flushed on background threads while the next chunk is computed.
+    def run(self, get_chunk, n_rows: int, chunk_rows: int):
+        if not self.needed:
+            return
+
+        outputs = [name for name in self.needed if self.stages[name].output and not self.stages[name].aggregate]
+        self.writers = dict()
+        try:
+            for name in outputs:
+                stage = self.stages[name]
+                fn = path.join(self.manifest.directory, stage.output)
+                self.writers[name] = ChunkWriter(fn, stage.dtype, self.io_stats)
+            with ThreadPoolExecutor(self.workers) as executor:
+                for start in range(0, n_rows, chunk_rows):
+                    self._run_chunk(get_chunk(start, min(start + chunk_rows, n_rows)), executor)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+
+        for name in outputs:
+            stage = self.stages[name]
+            self.manifest.record(stage.output, self.definition_hashes[name], stage.dtype, n_rows, self.durations[name])
+        for name in self.needed:
+            stage = self.stages[name]
+            if stage.aggregate and stage.output:
+                result = np.asarray(self.results[name], dtype=stage.dtype).ravel()
+                with open(path.join(self.manifest.directory, stage.output), 'wb+') as f:
+                    result.tofile(f)
+                definition_hash = self.definition_hashes[name]
+                self.manifest.record(stage.output, definition_hash, stage.dtype, len(result), self.durations[name])
+
+    # longest chain of dependent stages, by their total duration
+    def get_critical_path(self):
+        length, previous = dict(), dict()
+
+        def visit(name):
+            if name not in length:
+                deps = [dep for dep in self.stages[name].deps if dep in self.needed]
+                best = max(deps, key=visit, default=None)
+                previous[name] = best
+                length[name] = self.durations[name] + (length[best] if best else 0.0)
+            return length[name]
+
+        if not self.needed:
+            return [], 0.0
+        name = max(self.needed, key=visit)
+        total = length[name]
+        critical_path = []
+        while name is not None:
+            critical_path.append(name)
+            name = previous[name]
+        return critical_path[::-1], total
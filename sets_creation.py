@@ -95,6 +95,30 @@ def genset_k_by_inc(n, k):
     return X
 
 
+# Rows of genset_k_by_inc(n, k) with the given indices (ranks), without generating the other ones.
+# The rows are all compositions of k into n parts, in descending lexicographic order, so the first
+# C(k - v + n - 1, n - 1) rows are the ones with the first part >= v; the same holds for the next parts.
+def unrank_k(n, k, ranks):
+    ranks = np.array(ranks, dtype=np.int64)
+    X = np.zeros((len(ranks), n), dtype=np.int8)
+    remaining = np.full(len(ranks), k, dtype=np.int64)
+    for p in range(n - 1):
+        parts = n - p
+        # at_least[t + 1]: number of compositions of `remaining` into `parts` parts with the first one >= remaining - t
+        at_least = np.array([0] + [math.comb(t + parts - 1, parts - 1) for t in range(k + 1)], dtype=np.int64)
+        t = np.searchsorted(at_least[1:], ranks, side='right')
+        ranks -= at_least[t]
+        X[:, p] = remaining - t
+        remaining = t
+    X[:, n - 1] = remaining
+    return X
+
+
+# Rows start..stop-1 of genset_k_by_inc(n, k)
+def genset_k_by_range(n, k, start, stop):
+    return unrank_k(n, k, np.arange(start, stop, dtype=np.int64))
+
+
 def generate_dataset(n, k):
     start_time = time.time()
     print('Generating simplex data', end='')
@@ -0,0 +1,216 @@
+__all__ = [
+    'PARTIAL_FILE',
+    'MERGED_FILE',
+    'get_shards_dir',
+    'get_shard_ranges',
+    'ShardAggregates',
+    'run_shard',
+    'merge_shards',
+    'run_local',
+]
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from composites import save_composite_metrics
+from epsilon_curves import EpsilonCurves, Float16Axis
+from manifest import Manifest
+from metric_graph import get_metric_stages
+from scheduler import StageScheduler, parse_memory
+from sets_creation import genset_k_by_range, the_ratio
+from strata import SparseCounts, get_stratum_keys
+from stratum_summary import StratumSummary
+from utils import composite_metrics, data_cols, diff_metric_rates, rate_cells, ratio_metric_rates
+from value_codes import DiffDictionary
+
+# Shard-and-merge execution: the dataset is split into ranges of rows (shards), each computed independently,
+# e.g. on another machine, into its own directory out/shards/n<n>/rows_<start>_<stop>/: the metric files of its rows
+# (as in metrics_calculations, with its own manifest), and a small file of the partial aggregates of all the scripts
+# (PARTIAL_FILE). The partials are merged exactly into MERGED_FILE, which the scripts read with `shards_dir` set.
+# A local run uses the same protocol, with the shards computed by a pool of processes.
+PARTIAL_FILE = 'partial.npz'
+MERGED_FILE = 'merged.npz'
+
+
+def get_shards_dir(sample_size: int):
+    return path.join('out', 'shards', f'n{sample_size}')
+
+
+def get_shard_ranges(sample_size: int, n_shards: int):
+    bounds = np.linspace(0, the_ratio(8, sample_size), n_shards + 1).round().astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+# Partial aggregates of a range of rows, in the (GR, IR) strata (see strata.py), which are merged exactly:
+# the |diff| curves of the difference and composite metrics (epsilon_curves.py, float16 axis),
+# the counts of the undefined bitmasks for each GR and IR, the histogram cubes of the difference metrics
+# (histogram_cube.py) and the summaries of all the metrics (stratum_summary.py)
+class ShardAggregates:
+    def __init__(self, sample_size: int):
+        self.sample_size = sample_size
+        n_strata = (sample_size + 1) ** 2
+        curve_metrics = [*diff_metric_rates, *composite_metrics]
+        self.curves = {f'{metric}.bin': EpsilonCurves(Float16Axis(), n_strata) for metric in curve_metrics}
+        self.mask_counts = {ratio: 0 for ratio in ['gr', 'ir']}
+        self.cubes = {metric: SparseCounts() for metric in diff_metric_rates}
+        summary_metrics = [*diff_metric_rates, *ratio_metric_rates, *composite_metrics]
+        self.summaries = {metric: StratumSummary(n_strata) for metric in summary_metrics}
+
+    # one chunked pass over the files of the manifest
+    def add_files(self, manifest, stats=None):
+        n = self.sample_size
+        dictionary = DiffDictionary(n)
+        n_codes = dictionary.nan_code + 1
+        n_masks = 1 << (2 * len(rate_cells))
+        metrics = list(self.summaries)
+        files = ['gr.key.bin', 'ir.key.bin', 'undefined.bin'] + [f'{metric}.bin' for metric in metrics]
+
+        for gr_key, ir_key, mask, *chunks in zip(*(manifest.read_chunks(fn, stats=stats) for fn in files)):
+            strata = get_stratum_keys(gr_key, ir_key, n)
+            for ratio, keys in [('gr', gr_key), ('ir', ir_key)]:
+                self.mask_counts[ratio] += np.bincount(
+                    keys.astype(np.intp) * n_masks + mask, minlength=(n + 1) * n_masks
+                ).reshape(-1, n_masks)
+
+            for metric, values in zip(metrics, chunks):
+                self.summaries[metric].add(strata, values)
+                if f'{metric}.bin' in self.curves:
+                    curves = self.curves[f'{metric}.bin']
+                    curves.add(strata, *curves.axis.get_ranks(values))
+                if metric in self.cubes:
+                    self.cubes[metric].add(strata.astype(np.int64) * n_codes + dictionary.encode_values(values))
+        return self
+
+    def merge(self, other):
+        for fn, curves in self.curves.items():
+            curves.merge(other.curves[fn].totals, *other.curves[fn].get_counts())
+        for ratio in self.mask_counts:
+            self.mask_counts[ratio] = self.mask_counts[ratio] + other.mask_counts[ratio]
+        for metric, cube in self.cubes.items():
+            cube.add(*other.cubes[metric].result())
+        for metric, summary in self.summaries.items():
+            summary.merge(other.summaries[metric])
+        return self
+
+    # the histogram cube of a metric, as saved by histogram_cube.save_histogram_cube
+    def get_cube(self, metric: str):
+        return np.stack(self.cubes[metric].result(), axis=1).ravel()
+
+    def save(self, fn: str):
+        arrays = {'sample_size': np.array(self.sample_size)}
+        for name, curves in self.curves.items():
+            keys, counts = curves.get_counts()
+            arrays.update({f'curves:{name}:totals': curves.totals, f'curves:{name}:keys': keys})
+            arrays[f'curves:{name}:counts'] = counts
+        arrays.update({f'mask_counts:{ratio}': counts for ratio, counts in self.mask_counts.items()})
+        arrays.update({f'cubes:{metric}': self.get_cube(metric) for metric in self.cubes})
+        for metric, summary in self.summaries.items():
+            arrays.update({f'summaries:{metric}:{name}': a for name, a in summary.to_arrays().items()})
+        np.savez(fn, **arrays)
+
+    @staticmethod
+    def load(fn: str):
+        with np.load(fn) as f:
+            arrays = dict(f.items())
+        aggregates = ShardAggregates(int(arrays['sample_size']))
+        for name, curves in aggregates.curves.items():
+            curves.merge(*(arrays[f'curves:{name}:{part}'] for part in ['totals', 'keys', 'counts']))
+        aggregates.mask_counts = {ratio: arrays[f'mask_counts:{ratio}'] for ratio in aggregates.mask_counts}
+        for metric, cube in aggregates.cubes.items():
+            cube.add(*arrays[f'cubes:{metric}'].reshape(-1, 2).T)
+        for metric in aggregates.summaries:
+            prefix = f'summaries:{metric}:'
+            summary_arrays = {k.removeprefix(prefix): a for k, a in arrays.items() if k.startswith(prefix)}
+            aggregates.summaries[metric] = StratumSummary.from_arrays(summary_arrays)
+        return aggregates
+
+
+# the confusion matrices of the rows start + (first..last) of the dataset, computed from their indices
+def _shard_chunks(sample_size: int, start: int):
+    def get_chunk(first, last):
+        X = genset_k_by_range(8, sample_size, start + first, start + last)
+        return pd.DataFrame(X, columns=data_cols, index=pd.RangeIndex(start + first, start + last))
+
+    return get_chunk
+
+
+# Computes the metric files of the rows start..stop-1 (those up to date in the shard's manifest are not recomputed)
+# and saves their partial aggregates; returns the partial file
+def run_shard(sample_size: int, start: int, stop: int, max_memory=None, workers=None):
+    shard_dir = path.join(get_shards_dir(sample_size), f'rows_{start}_{stop}')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    get_chunk = _shard_chunks(sample_size, start)
+    virtual_dataset = (f'Set(08,{sample_size})[{start}:{stop}]', get_chunk)
+    manifest = Manifest(shard_dir, virtual_dataset=virtual_dataset, sample_size=sample_size)
+    scheduler = StageScheduler(get_metric_stages(sample_size), manifest, workers)
+    if scheduler.needed:
+        scheduler.run(get_chunk, stop - start, scheduler.get_chunk_rows(max_memory, source_row_bytes=40))
+    save_composite_metrics(manifest, sample_size)
+
+    fn = path.join(shard_dir, PARTIAL_FILE)
+    ShardAggregates(sample_size).add_files(manifest).save(fn)
+    return fn
+
+
+# Merges the partial files of all the shards, which have to cover the dataset exactly once
+def merge_shards(sample_size: int, partial_files=None):
+    shards_dir = get_shards_dir(sample_size)
+    partial_files = partial_files or glob(path.join(shards_dir, 'rows_*', PARTIAL_FILE))
+    ranges = sorted(tuple(map(int, path.basename(path.dirname(fn)).split('_')[1:])) + (fn,) for fn in partial_files)
+
+    covered = 0
+    for start, stop, fn in ranges:
+        assert start >= covered, f'Rows {start}..{covered - 1} are covered by more than one shard'
+        assert start <= covered, f'Rows {covered}..{start - 1} are not covered by the shards'
+        covered = stop
+    assert covered == the_ratio(8, sample_size), f'Rows from {covered} on are not covered by the shards'
+
+    merged = ShardAggregates(sample_size)
+    for _, _, fn in ranges:
+        merged.merge(ShardAggregates.load(fn))
+    fn = path.join(shards_dir, MERGED_FILE)
+    merged.save(fn)
+    return fn
+
+
+# Local launcher: every shard in its own process (with one thread for its stages), then the merge
+def run_local(sample_size: int, n_shards: int, processes=None, max_memory=None):
+    ranges = get_shard_ranges(sample_size, n_shards)
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(run_shard, sample_size, start, stop, max_memory, 1) for start, stop in ranges]
+        partial_files = [future.result() for future in futures]
+    return merge_shards(sample_size, partial_files)
+
+
+# e.g. on each machine: python shards.py run 56 <start> <stop>, then: python shards.py merge 56
+# or locally: python shards.py local 56 --shards 16 --processes 4
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='compute the shard of rows start..stop-1')
+    merge_parser = commands.add_parser('merge', help='merge the partial results of all the shards')
+    local_parser = commands.add_parser('local', help='compute all the shards in local processes, and merge them')
+    for command_parser in [run_parser, merge_parser, local_parser]:
+        command_parser.add_argument('sample_size', type=int)
+    run_parser.add_argument('start', type=int)
+    run_parser.add_argument('stop', type=int)
+    run_parser.add_argument('--workers', type=int, default=None)
+    local_parser.add_argument('--shards', type=int, required=True)
+    local_parser.add_argument('--processes', type=int, default=None)
+    for command_parser in [run_parser, local_parser]:
+        command_parser.add_argument('--max-memory', type=parse_memory, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        print(run_shard(args.sample_size, args.start, args.stop, args.max_memory, args.workers))
+    elif args.command == 'merge':
+        print(merge_shards(args.sample_size))
+    else:
+        print(run_local(args.sample_size, args.shards, args.processes, args.max_memory))
@@ -0,0 +1,92 @@
+__all__ = [
+    'get_stratum_key_dtype',
+    'get_ratio_keys',
+    'get_stratum_keys',
+    'get_joint_strata',
+    'get_ratio_columns',
+    'get_stratum_sizes',
+    'SparseCounts',
+]
+
+import numpy as np
+
+
+# Strata are identified by integer keys instead of float ratios: the numerator of GR (size of the majority group)
+# and of IR (number of positives), both in 0..sample_size. metrics_calculations saves them as `gr.key.bin` and
+# `ir.key.bin`, and the (GR, IR) stratum is the combined key `gr_key * (sample_size + 1) + ir_key`.
+def get_stratum_key_dtype(sample_size: int):
+    return np.uint8 if sample_size <= np.iinfo(np.uint8).max else np.uint16
+
+
+# keys of the given ratios (e.g. [1/28, 1/2]), which have to be multiples of 1/sample_size
+def get_ratio_keys(ratios, sample_size: int):
+    scaled = np.asarray(ratios, dtype=np.float64) * sample_size
+    keys = np.round(scaled).astype(np.intp)
+    assert np.allclose(keys, scaled) and ((keys >= 0) & (keys <= sample_size)).all(), f'No strata with ratios {ratios}'
+    return keys
+
+
+def get_stratum_keys(gr_key, ir_key, sample_size: int):
+    return gr_key.astype(np.intp) * (sample_size + 1) + ir_key
+
+
+# GR and IR keys of every (GR, IR) stratum, e.g. to marginalize per-stratum results to GR or IR
+def get_joint_strata(sample_size: int):
+    n_keys = sample_size + 1
+    return {'gr': np.arange(n_keys**2) // n_keys, 'ir': np.arange(n_keys**2) % n_keys}
+
+
+# columns of the ratios of the strata: GR or IR, or both for the (GR, IR) strata (`ratio_type` 'gr_ir')
+def get_ratio_columns(ratio_type: str, strata, sample_size: int):
+    if ratio_type == 'gr_ir':
+        return {ratio: keys.take(strata) / sample_size for ratio, keys in get_joint_strata(sample_size).items()}
+    return {ratio_type: strata / sample_size}
+
+
+# Rows of the dataset in each (GR, IR) stratum, by stratum key. A group of s rows with q positives has (q + 1) splits
+# of the positives into TP and FN, and (s - q + 1) of the negatives into FP and TN; the positives of a stratum are
+# shared between the majority group (gr_key rows) and the minority group (the rest).
+def get_stratum_sizes(sample_size: int):
+    k = np.arange(sample_size + 1)
+    splits = np.where(k <= k[:, np.newaxis], (k + 1) * (k[:, np.newaxis] - k + 1), 0).astype(np.int64)
+    sizes = [np.convolve(splits[g], splits[sample_size - g])[: sample_size + 1] for g in k]
+    return np.concatenate(sizes)
+
+
+# Counts of integer keys from a large key space (e.g. a stratum and a value), of which only a few occur:
+# the distinct keys of each chunk are counted, and merged with the previous ones once they outnumber them,
+# so that each key is sorted only a few times
+class SparseCounts:
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending = list()
+
+    @staticmethod
+    def _merge(keys, counts):
+        if len(keys) == 0:
+            return keys, counts
+        order = np.argsort(keys, kind='stable')
+        keys, counts = keys[order], counts[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        return keys[starts], np.add.reduceat(counts, starts)
+
+    def _flush(self):
+        self.keys, self.counts = self._merge(*map(np.concatenate, zip((self.keys, self.counts), *self._pending)))
+        self._pending = list()
+
+    # each of the keys once, or `counts` times
+    def add(self, keys, counts=None):
+        keys = np.asarray(keys, dtype=np.int64)
+        if counts is None:
+            self._pending.append(np.unique(keys, return_counts=True))
+        else:
+            self._pending.append(self._merge(keys, np.asarray(counts, dtype=np.int64)))
+        if sum(len(chunk_keys) for chunk_keys, _ in self._pending) > len(self.keys):
+            self._flush()
+        return self
+
+    # the distinct keys, sorted, and their counts
+    def result(self):
+        self._flush()
+        return self.keys, self.counts
@@ -0,0 +1,118 @@
+__all__ = [
+    'StratumCorrelation',
+]
+
+from itertools import combinations_with_replacement
+
+import numpy as np
+
+from strata import SparseCounts
+
+
+# Co-moments (count, means of x and y, and the sums of the products of their deviations: xx, yy, xy) of groups
+# of parts, each part with its own co-moments: `groups[p]` is the group of part p. Used both for the rows of a chunk
+# (each a part of count 1) and to merge the co-moments of chunks (Chan et al.'s pairwise formulas).
+def _combine_comoments(groups, comoments, n_groups: int):
+    counts, x_means, y_means, xx, yy, xy = comoments
+    total = np.bincount(groups, weights=counts, minlength=n_groups)
+    x_mean, y_mean = (
+        np.bincount(groups, weights=counts * means, minlength=n_groups) / np.maximum(total, 1)
+        for means in (x_means, y_means)
+    )
+    dx, dy = x_means - x_mean.take(groups), y_means - y_mean.take(groups)
+    return (
+        total,
+        x_mean,
+        y_mean,
+        np.bincount(groups, weights=xx + counts * dx * dx, minlength=n_groups),
+        np.bincount(groups, weights=yy + counts * dy * dy, minlength=n_groups),
+        np.bincount(groups, weights=xy + counts * dx * dy, minlength=n_groups),
+    )
+
+
+def _get_correlation(comoments):
+    _, _, _, xx, yy, xy = comoments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((xx > 0) & (yy > 0), xy / np.sqrt(xx * yy), np.nan)
+
+
+# Pearson and Spearman correlations between every pair of metrics in each stratum, over the rows where both metrics
+# are defined, from the chunks of the metric files read side by side. Each metric is given as float64 values and
+# as codes into the sorted array of its possible values (see value_codes.DiffDictionary), `nan_code` for NaN.
+# Spearman's correlation is Pearson's of the ranks (ties get their mean rank), which depend on all the rows of
+# the stratum: the codes are counted in a first pass (`count_codes`), and the co-moments in a second one (`add`).
+# Memory is bounded by the number of strata and of possible values, not of rows.
+class StratumCorrelation:
+    def __init__(self, n_metrics: int, n_strata: int, nan_code: int):
+        self.n_metrics = n_metrics
+        self.n_strata = n_strata
+        self.nan_code = nan_code
+        # every pair of metrics, each one with itself included
+        self.pairs = list(combinations_with_replacement(range(n_metrics), 2))
+        self._code_counts = SparseCounts()
+        self._rank_keys = self._ranks = None
+        zeros = lambda: tuple(np.zeros(n_strata) for _ in range(6))
+        self.values = [zeros() for _ in self.pairs]
+        self.ranks = [zeros() for _ in self.pairs]
+
+    # rows of a chunk where both metrics of each pair are defined
+    def _get_pairs(self, codes):
+        defined = [c != self.nan_code for c in codes]
+        for p, (a, b) in enumerate(self.pairs):
+            yield p, a, b, defined[a] & defined[b]
+
+    # keys of the codes of metric `side` (0 or 1) of pair `p` in the strata
+    def _get_keys(self, p, side, strata, codes):
+        group = (2 * p + side) * self.n_strata + strata.astype(np.int64)
+        return group * (self.nan_code + 1) + codes
+
+    # first pass: counts of the codes of each metric in each stratum, for each pair
+    def count_codes(self, strata, codes):
+        for p, a, b, defined in self._get_pairs(codes):
+            for side, m in enumerate((a, b)):
+                self._code_counts.add(self._get_keys(p, side, strata[defined], codes[m][defined]))
+        return self
+
+    # mean rank of each counted code in its stratum: the rows below it, and half of the rows with the same code
+    def _rank_codes(self):
+        keys, counts = self._code_counts.result()
+        groups = keys // (self.nan_code + 1)
+        starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+        below = np.cumsum(counts) - counts
+        below -= np.repeat(below[starts], np.diff(np.append(starts, len(keys))))
+        self._rank_keys, self._ranks = keys, below + (counts + 1) / 2
+
+    # second pass: co-moments of the values and of their ranks
+    def add(self, strata, values, codes):
+        if self._ranks is None:
+            self._rank_codes()
+        strata = np.asarray(strata, dtype=np.int64)
+        for p, a, b, defined in self._get_pairs(codes):
+            s = strata[defined]
+            ones, zeros = np.ones(len(s)), np.zeros(len(s))
+            ranks = [
+                self._ranks.take(np.searchsorted(self._rank_keys, self._get_keys(p, side, s, codes[m][defined])))
+                for side, m in enumerate((a, b))
+            ]
+            for state, (x, y) in [(self.values, (values[a][defined], values[b][defined])), (self.ranks, ranks)]:
+                chunk = _combine_comoments(s, (ones, x, y, zeros, zeros, zeros), self.n_strata)
+                merged = [np.concatenate(pair) for pair in zip(state[p], chunk)]
+                state[p] = _combine_comoments(np.tile(np.arange(self.n_strata), 2), merged, self.n_strata)
+        return self
+
+    # strata x metrics x metrics tensor of the pairs' values: the number of rows where both are defined,
+    # and Pearson's and Spearman's correlations (NaN where either metric is constant or never defined)
+    def _get_tensor(self, get_value, comoments):
+        tensor = np.empty((self.n_strata, self.n_metrics, self.n_metrics))
+        for (a, b), pair_comoments in zip(self.pairs, comoments):
+            tensor[:, a, b] = tensor[:, b, a] = get_value(pair_comoments)
+        return tensor
+
+    def get_counts(self):
+        return self._get_tensor(lambda comoments: comoments[0], self.values).astype(np.int64)
+
+    def get_pearson(self):
+        return self._get_tensor(_get_correlation, self.values)
+
+    def get_spearman(self):
+        return self._get_tensor(_get_correlation, self.ranks)
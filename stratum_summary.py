@@ -0,0 +1,189 @@
+__all__ = [
+    'get_order_keys',
+    'get_order_values',
+    'StratumSummary',
+]
+
+import numpy as np
+import pandas as pd
+
+_MAGNITUDE_BITS = np.int64(0x7FFFFFFFFFFFFFFF)
+
+
+# float64 values as int64 keys in the same order (-0.0 as 0.0), so that their distinct values are counted and sorted
+# as integers: the bits of negative values are flipped, except for the sign
+def get_order_keys(values):
+    bits = (np.asarray(values, dtype=np.float64) + 0.0).view(np.int64)
+    return np.where(bits < 0, bits ^ _MAGNITUDE_BITS, bits)
+
+
+def get_order_values(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.where(keys < 0, keys ^ _MAGNITUDE_BITS, keys).view(np.float64)
+
+
+# Moments (count, mean, and the sums of the 2nd and 3rd powers of the deviations from the mean) of groups of parts,
+# each part with its own moments: `groups[p]` is the group of part p. Used both for the values of a chunk
+# (each value a part of count 1) and to merge the moments of chunks, or of strata (Chan et al.'s pairwise formulas,
+# summed over all the parts of a group at once).
+def _combine_moments(groups, moments, n_groups: int):
+    counts, means, m2, m3 = moments
+    total = np.bincount(groups, weights=counts, minlength=n_groups)
+    mean = np.bincount(groups, weights=counts * means, minlength=n_groups) / np.maximum(total, 1)
+    deviation = means - mean.take(groups)
+    return (
+        total,
+        mean,
+        np.bincount(groups, weights=m2 + counts * deviation**2, minlength=n_groups),
+        np.bincount(groups, weights=m3 + 3 * deviation * m2 + counts * deviation**3, minlength=n_groups),
+    )
+
+
+# Counts of the distinct (stratum, value key) pairs, sorted by stratum and then by value
+def _merge_counts(strata, keys, counts):
+    if len(keys) == 0:
+        return strata, keys, counts
+    order = np.lexsort((keys, strata))
+    strata, keys, counts = strata[order], keys[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], (strata[1:] != strata[:-1]) | (keys[1:] != keys[:-1])]))
+    return strata[starts], keys[starts], np.add.reduceat(counts, starts)
+
+
+# Per-stratum statistics of the values of a metric, added chunk by chunk: numbers of NaNs and of infinite values,
+# moments of the finite values (mean, variance, skewness), and the counts of their distinct values, from which
+# quantiles are exact. Summaries of separate parts of the rows can be merged, and those of strata summed up
+# into coarser strata (e.g. GR from (GR, IR)).
+class StratumSummary:
+    def __init__(self, n_strata: int):
+        self.n_strata = n_strata
+        self.nans = np.zeros(n_strata, dtype=np.int64)
+        self.infs = np.zeros(n_strata, dtype=np.int64)
+        self.moments = tuple(np.zeros(n_strata) for _ in range(4))
+        self._strata = self._keys = self._counts = np.empty(0, dtype=np.int64)
+        self._pending = list()
+
+    # distinct values are merged with the previous ones once they outnumber them, as in strata.SparseCounts
+    def _add_counts(self, strata, keys, counts):
+        self._pending.append(_merge_counts(strata, keys, counts))
+        if sum(len(keys) for _, keys, _ in self._pending) > len(self._keys):
+            self._flush()
+
+    def _flush(self):
+        parts = zip((self._strata, self._keys, self._counts), *self._pending)
+        self._strata, self._keys, self._counts = _merge_counts(*map(np.concatenate, parts))
+        self._pending = list()
+
+    # merges moments of the same strata
+    def _merge_moments(self, moments):
+        parts = [np.concatenate(pair) for pair in zip(self.moments, moments)]
+        self.moments = _combine_moments(np.tile(np.arange(self.n_strata), 2), parts, self.n_strata)
+
+    def add(self, strata, values):
+        strata, values = np.asarray(strata, dtype=np.int64), np.asarray(values, dtype=np.float64)
+        nan, inf = np.isnan(values), np.isinf(values)
+        self.nans += np.bincount(strata[nan], minlength=self.n_strata)
+        self.infs += np.bincount(strata[inf], minlength=self.n_strata)
+
+        finite = np.logical_not(nan | inf)
+        strata, values = strata[finite], values[finite]
+        ones, zeros = np.ones(len(values)), np.zeros(len(values))
+        chunk_moments = _combine_moments(strata, (ones, values, zeros, zeros), self.n_strata)
+        self._merge_moments(chunk_moments)
+        self._add_counts(strata, get_order_keys(values), np.ones(len(values), dtype=np.int64))
+        return self
+
+    # summary of the rows of both summaries, e.g. of separate ranges of the dataset
+    def merge(self, other):
+        assert other.n_strata == self.n_strata
+        self.nans += other.nans
+        self.infs += other.infs
+        self._merge_moments(other.moments)
+        self._add_counts(*other.get_value_counts())
+        return self
+
+    # the state of the summary as arrays, e.g. to save partial results, and the summary from them
+    def to_arrays(self):
+        counts, means, m2, m3 = self.moments
+        value_strata, value_keys, value_counts = self.get_value_counts()
+        return {
+            'nans': self.nans,
+            'infs': self.infs,
+            'counts': counts,
+            'means': means,
+            'm2': m2,
+            'm3': m3,
+            'value_strata': value_strata,
+            'value_keys': value_keys,
+            'value_counts': value_counts,
+        }
+
+    @staticmethod
+    def from_arrays(arrays):
+        summary = StratumSummary(len(arrays['nans']))
+        summary.nans, summary.infs = arrays['nans'], arrays['infs']
+        summary.moments = tuple(arrays[name] for name in ['counts', 'means', 'm2', 'm3'])
+        summary._add_counts(*(arrays[name] for name in ['value_strata', 'value_keys', 'value_counts']))
+        return summary
+
+    # summary of coarser strata: `strata_map[s]` is the new stratum of s
+    def marginalize(self, strata_map, n_strata: int):
+        strata_map = np.asarray(strata_map, dtype=np.int64)
+        summary = StratumSummary(n_strata)
+        summary.nans = np.bincount(strata_map, weights=self.nans, minlength=n_strata).astype(np.int64)
+        summary.infs = np.bincount(strata_map, weights=self.infs, minlength=n_strata).astype(np.int64)
+        summary.moments = _combine_moments(strata_map, self.moments, n_strata)
+        strata, keys, counts = self.get_value_counts()
+        summary._add_counts(strata_map.take(strata), keys, counts)
+        return summary
+
+    # the distinct (stratum, value key) pairs of the finite values, sorted, and their counts
+    def get_value_counts(self):
+        self._flush()
+        return self._strata, self._keys, self._counts
+
+    # Quantiles of the finite values of each stratum (strata x qs), interpolated linearly between the values
+    # around them, as the default of np.quantile and pandas; NaN for strata without finite values
+    def get_quantiles(self, qs):
+        strata, keys, counts = self.get_value_counts()
+        if len(keys) == 0:
+            return np.full((self.n_strata, len(qs)), np.nan)
+        values = get_order_values(keys)
+        cumulative = np.cumsum(counts)
+        n = np.bincount(strata, weights=counts, minlength=self.n_strata).astype(np.int64)
+        starts = np.concatenate([[0], np.cumsum(n)[:-1]])
+
+        position = (np.maximum(n, 1) - 1)[:, np.newaxis] * np.asarray(qs, dtype=np.float64)[np.newaxis, :]
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(n, 1)[:, np.newaxis] - 1)
+        # values of the rows with these ranks (in ascending order) in their strata
+        low, high = (
+            values.take(np.searchsorted(cumulative, starts[:, np.newaxis] + rank, side='right'), mode='clip')
+            for rank in (lower, upper)
+        )
+        quantiles = np.where(high > low, low + (position - lower) * (high - low), low)
+        quantiles[n == 0] = np.nan
+        return quantiles
+
+    # One row per stratum with any rows: numbers of rows, NaNs and infinite values, and the mean, variance (ddof=1),
+    # skewness (adjusted, as pandas) and quantiles of the finite values, in columns `q<q>` (e.g. q0.05)
+    def to_frame(self, qs=(0.05, 0.5, 0.95)):
+        n, mean, m2, m3 = self.moments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = np.where(n > 1, m2 / (n - 1), np.nan)
+            skewness = np.sqrt(n * (n - 1)) / (n - 2) * (m3 / n) / (m2 / n) ** 1.5
+        # strata of equal values, up to rounding errors, are not skewed (as in pandas)
+        skewness = np.where(n > 2, np.where(m2 / np.maximum(n, 1) > 1e-14, skewness, 0), np.nan)
+
+        df = pd.DataFrame(
+            {
+                'count': n.astype(np.int64) + self.nans + self.infs,
+                'nan': self.nans,
+                'inf': self.infs,
+                'mean': np.where(n > 0, mean, np.nan),
+                'var': variance,
+                'skew': skewness,
+            }
+        )
+        for q, quantiles in zip(qs, self.get_quantiles(qs).T):
+            df[f'q{q:g}'] = quantiles
+        return df.loc[df['count'] > 0]
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the shared modules of the repository, when the tests are run from any directory
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,27 @@
+from manifest import get_definition_hash
+from value_codes import DiffDictionary
+
+
+class Scale:
+    def __init__(self, factor):
+        self.factor = factor
+
+    def apply(self, values):
+        return values * self.factor
+
+
+def test_bound_methods_hash_their_instance():
+    assert get_definition_hash(Scale(2).apply) == get_definition_hash(Scale(2).apply)
+    assert get_definition_hash(Scale(2).apply) != get_definition_hash(Scale(3).apply)
+
+
+def test_bound_methods_hash_their_code():
+    class Shift(Scale):
+        def apply(self, values):
+            return values + self.factor
+
+    assert get_definition_hash(Scale(2).apply) != get_definition_hash(Shift(2).apply)
+
+
+def test_dictionary_encoding_depends_on_the_sample_size():
+    assert get_definition_hash(DiffDictionary(12).encode_rates) != get_definition_hash(DiffDictionary(56).encode_rates)
@@ -0,0 +1,14 @@
+from manifest import get_definition_hash
+from metric_graph import get_metric_stages
+
+
+def get_compute_hashes(sample_size: int, **options):
+    return {stage.name: get_definition_hash(stage.compute) for stage in get_metric_stages(sample_size, **options)}
+
+
+# the codes of a difference metric are computed by a bound method of the dictionary of the sample size,
+# so that the cached .codes.bin files of another sample size are not up to date
+def test_code_stages_depend_on_the_sample_size():
+    hashes = [get_compute_hashes(sample_size, output_format='codes') for sample_size in [12, 14]]
+    assert hashes[0]['stat_parity_code'] == get_compute_hashes(12, output_format='codes')['stat_parity_code']
+    assert hashes[0]['stat_parity_code'] != hashes[1]['stat_parity_code']
@@ -0,0 +1,30 @@
+import numpy as np
+
+from manifest import Manifest
+from zone_maps import get_zone_columns, save_zone_maps
+
+
+def first_dataset(start, stop):
+    return np.zeros(stop - start)
+
+
+def second_dataset(start, stop):
+    return np.ones(stop - start)
+
+
+# files of an earlier dataset, e.g. codes saved in virtual mode before switching to the dataset file, stay in the
+# manifest with the same number of rows, but are not columns of the current dataset
+def test_zone_columns_after_switching_the_dataset(tmp_path):
+    directory = str(tmp_path)
+    first = Manifest(directory, virtual_dataset=('first', first_dataset))
+    first.save('gr.bin', lambda: np.linspace(0, 1, 1000))
+    first.save('equal_opp_diff.codes.bin', lambda: np.arange(1000, dtype=np.uint16))
+
+    second = Manifest(directory, virtual_dataset=('second', second_dataset))
+    second.save('gr.bin', lambda: np.linspace(0, 1, 1000))
+    second.save('equal_opp_diff.bin', lambda: np.linspace(-1, 1, 1000))
+
+    columns = get_zone_columns(second)
+    assert sorted(columns) == ['equal_opp_diff.bin', 'gr.bin']
+    save_zone_maps(second, columns, zone_rows=100)
+    assert second.view('equal_opp_diff.zones.bin').reshape(-1, 3)[0, 0] == -1
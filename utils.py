@@ -1,4 +1,9 @@
 __all__ = [
+    'data_cols',
+    'rate_cells',
+    'diff_metric_rates',
+    'ratio_metric_rates',
+    'ratio_categories',
     'get_group_ratios',
     'get_imbalance_ratios',
     'get_stereotypical_bias',
@@ -22,13 +27,76 @@ __all__ = [
     'get_pos_pred_parity_diff',
     'get_neg_pred_parity_ratio',
     'get_neg_pred_parity_diff',
+    'get_equalized_odds',
+    'get_cond_use_acc_equality',
+    'get_treatment_equality',
+    'get_size_stereotypical_bias',
+    'composite_metrics',
+    'get_fraction_dtype',
+    'get_cells_sum',
+    'get_rate_fraction',
+    'get_epsilon_fraction',
+    'get_undefined_bit',
     'Timer',
 ]
 
-import pandas as pd
+from fractions import Fraction
 from os import path
 from time import perf_counter
 
+import numpy as np
+import pandas as pd
+
+data_cols = [
+    'i_tp',  # minority true positive
+    'i_fp',  # minority false positive
+    'i_tn',  # minority true negative
+    'i_fn',  # minority false negative
+    'j_tp',  # majority true positive
+    'j_fp',  # majority false positive
+    'j_tn',  # majority true negative
+    'j_fn',  # majority false negative
+]
+
+# Every per-group rate has the form a / (a + b), where a and b are sums of confusion matrix cells
+rate_cells = {  # { rate: (cells of a, cells of b) }
+    'tpr': (('tp',), ('fn',)),
+    'fpr': (('fp',), ('tn',)),
+    'ppv': (('tp',), ('fp',)),
+    'npv': (('tn',), ('fn',)),
+    'pr': (('tp', 'fp'), ('tn', 'fn')),  # positive rate, used by statistical parity
+    'acc': (('tp', 'tn'), ('fp', 'fn')),  # accuracy, used by accuracy equality
+    'fn_share': (('fn',), ('fp',)),  # share of false negatives among the errors, used by treatment equality
+}
+
+# Difference metrics (named as their output files) and the per-group rate they compare
+diff_metric_rates = {
+    'stat_parity': 'pr',
+    'acc_equality_diff': 'acc',
+    'equal_opp_diff': 'tpr',
+    'pred_equality_diff': 'fpr',
+    'pos_pred_parity_diff': 'ppv',
+    'neg_pred_parity_diff': 'npv',
+}
+
+# Ratio metrics (named as their output files) and the per-group rate they compare
+ratio_metric_rates = {
+    'disp_impact': 'pr',
+    'acc_equality_ratio': 'acc',
+    'equal_opp_ratio': 'tpr',
+    'pred_equality_ratio': 'fpr',
+    'pos_pred_parity_ratio': 'ppv',
+    'neg_pred_parity_ratio': 'npv',
+}
+
+# Categories of a ratio metric value (majority rate / minority rate), stored as their index
+ratio_categories = [
+    'finite',
+    'inf',  # x / 0, with x > 0
+    'zero_by_zero',  # 0 / 0
+    'undefined',  # at least one of the rates is undefined (zero denominator)
+]
+
 
 # Group Ratio
 def get_group_ratios(df: pd.DataFrame):
@@ -151,6 +219,73 @@ def get_neg_pred_parity_diff(j_npv, i_npv):
     return j_npv - i_npv
 
 
+# Composite metrics, computed from the per-group quantities of two rates (see `composite_metrics`)
+
+# Equalized Odds
+# the larger of the equal opportunity and predictive equality differences (in absolute value)
+def get_equalized_odds(j_tpr, i_tpr, j_fpr, i_fpr):
+    return np.maximum(np.abs(j_tpr - i_tpr), np.abs(j_fpr - i_fpr))
+
+
+# Conditional Use Accuracy Equality
+# the larger of the positive and negative predictive parity differences (in absolute value)
+def get_cond_use_acc_equality(j_ppv, i_ppv, j_npv, i_npv):
+    return np.maximum(np.abs(j_ppv - i_ppv), np.abs(j_npv - i_npv))
+
+
+# Treatment Equality
+# difference of the ratios of false negatives to false positives
+def get_treatment_equality(j_fn_fp, i_fn_fp):
+    return j_fn_fp - i_fn_fp
+
+
+# Stereotypical bias, from the sizes of the groups (same values as get_stereotypical_bias)
+def get_size_stereotypical_bias(j_size, i_size):
+    return i_size / j_size - j_size / i_size
+
+
+# Composite metrics (named as their output files): their function, and its arguments as (quantity, rate) pairs,
+# each giving the majority and minority group's argument. For a rate a / (a + b), the quantity is
+# 'rate' (a / (a + b)), 'odds' (a / b) or 'total' (a + b).
+composite_metrics = {
+    'equalized_odds': (get_equalized_odds, [('rate', 'tpr'), ('rate', 'fpr')]),
+    'cond_use_acc_equality': (get_cond_use_acc_equality, [('rate', 'ppv'), ('rate', 'npv')]),
+    'treatment_equality': (get_treatment_equality, [('odds', 'fn_share')]),
+    'stereotypical_bias': (get_size_stereotypical_bias, [('total', 'pr')]),
+}
+
+
+# Sum of the given cells (e.g. ('tp', 'fn')) of one group's confusion matrix
+def get_cells_sum(df, group: str, cells, dtype):
+    total = np.zeros(len(df), dtype=dtype)
+    for cell in cells:
+        total += np.asarray(df[f'{group}_{cell}']).astype(dtype)
+    return total
+
+
+# Exact rates
+# each rate is kept as an integer (numerator, denominator) pair; both are at most the sample size
+def get_fraction_dtype(sample_size: int):
+    return np.uint8 if sample_size <= np.iinfo(np.uint8).max else np.uint16
+
+
+def get_rate_fraction(df, rate: str, group: str, sample_size: int):
+    dtype = get_fraction_dtype(sample_size)
+    a_cells, b_cells = rate_cells[rate]
+    num = get_cells_sum(df, group, a_cells, dtype)
+    return num, num + get_cells_sum(df, group, b_cells, dtype)
+
+
+# a small non-negative epsilon as a fraction; floats are read as their decimal representation, e.g. 0.01 -> 1/100
+def get_epsilon_fraction(epsilon):
+    return Fraction(str(epsilon)) if isinstance(epsilon, float) else Fraction(epsilon)
+
+
+# Bit of the undefined-values bitmask, set when the rate of the group has a zero denominator
+def get_undefined_bit(rate: str, group: str):
+    return 1 << (2 * list(rate_cells).index(rate) + (group == 'j'))
+
+
 class Timer:
     def __init__(self):
         self.records = list()
@@ -179,6 +314,11 @@ class Timer:
 
         return self.current[label]
 
+    # record a duration measured elsewhere, e.g. the total time of a stage over all chunks
+    def record(self, label: str, seconds: float):
+        assert self.current is not None, "Start the timer first!"
+        self.current[label] = seconds
+
     def reset(self):
         if self.current:
             self.records.append(self.current)
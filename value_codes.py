@@ -0,0 +1,73 @@
+__all__ = [
+    'DiffDictionary',
+    'get_code_dtype',
+    'get_histogram_from_counts',
+]
+
+import numpy as np
+
+from rate_tables import get_rate_lut, get_rate_table
+from utils import diff_metric_rates
+
+
+# Dictionary encoding of difference metrics
+# A difference of two rates (each a fraction with denominator <= n) can take only a limited number of values,
+# so each row is stored as a code into the sorted array of all of them. The code `len(values)` is reserved for NaN.
+class DiffDictionary:
+    def __init__(self, sample_size: int):
+        # part of the definition hash of the stages encoding with the dictionary (see manifest.get_definition_hash)
+        self.sample_size = sample_size
+        table = get_rate_table(sample_size)
+        # only a + b <= n can occur in a group's confusion matrix
+        a = np.arange(sample_size + 1)
+        table[a[:, np.newaxis] + a[np.newaxis, :] > sample_size] = np.nan
+
+        self.rate_values = np.unique(table[~np.isnan(table)])
+        # NaN is sorted to the end, so it gets the code len(rate_values)
+        self.rate_codes = np.searchsorted(self.rate_values, table).astype(np.int32)
+
+        # computed exactly as in the float path, so decoding gives the same float64 values
+        diffs = self.rate_values[:, np.newaxis] - self.rate_values[np.newaxis, :]
+        self.values = np.unique(diffs)
+        self.nan_code = len(self.values)
+        self.dtype = get_code_dtype(self.values)
+
+        k = len(self.rate_values)
+        self.pair_codes = np.full((k + 1, k + 1), self.nan_code, dtype=self.dtype)
+        self.pair_codes[:k, :k] = np.searchsorted(self.values, diffs)
+
+    # majority - minority difference, as codes
+    def encode(self, df, metric: str):
+        rate = diff_metric_rates[metric]
+        j_codes = get_rate_lut(df, rate, 'j', self.rate_codes)
+        return self.encode_rates(j_codes, get_rate_lut(df, rate, 'i', self.rate_codes))
+
+    # the same, from the codes of the two rates (`rate_codes` gathered with `get_rate_index`)
+    def encode_rates(self, j_codes, i_codes):
+        return self.pair_codes.ravel().take(j_codes * self.pair_codes.shape[1] + i_codes)
+
+    def decode(self, codes):
+        return np.append(self.values, np.nan).take(codes)
+
+    # codes of float64 values of a difference metric, e.g. read from its file (NaN gets `nan_code`)
+    def encode_values(self, values):
+        codes = np.searchsorted(self.values, values)
+        nan = np.isnan(values)
+        codes[nan] = self.nan_code
+        assert (self.values.take(codes[~nan], mode='clip') == values[~nan]).all(), 'Values missing from the dictionary'
+        return codes.astype(self.dtype)
+
+    def code_of(self, value: float):
+        idx = np.searchsorted(self.values, value)
+        return idx if idx < self.nan_code and self.values[idx] == value else None
+
+
+def get_code_dtype(values):
+    return np.uint16 if len(values) <= np.iinfo(np.uint16).max else np.uint32
+
+
+# Same result as np.histogram on the decoded values, from the counts of each code (the last one counts NaNs,
+# which are left out)
+def get_histogram_from_counts(values, counts, bins):
+    present = counts[:-1] > 0
+    return np.histogram(values[present], bins=bins, weights=counts[:-1][present])
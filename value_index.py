@@ -0,0 +1,149 @@
+__all__ = [
+    'get_index_key_dtype',
+    'get_index_id_dtype',
+    'get_index_keys',
+    'save_value_index',
+    'ValueIndex',
+    'get_dataset_rows',
+]
+
+import math
+
+import numpy as np
+import pandas as pd
+
+from chunked_io import DEFAULT_CHUNK_ROWS, release_pages
+from sets_creation import unrank_k
+from utils import data_cols
+from value_codes import DiffDictionary
+
+
+# Inverted index from the values of a difference metric to the rows of the dataset
+# Each row gets the key (value code, GR key, IR key), where the GR and IR keys are the numerators of the ratios
+# (e.g. GR = 2/56 has the key 2). metrics_calculations (with `index = True`) sorts the keys and row ids of every chunk
+# and saves them as `<metric>.index.runs.keys.bin` and `<metric>.index.runs.ids.bin`, so the files are made of sorted
+# runs, which save_value_index then merges into `<metric>.index.keys.bin` and `<metric>.index.ids.bin`, sorted by key
+# (the ids of each key in increasing order).
+def get_index_key_dtype(dictionary: DiffDictionary, sample_size: int):
+    # the largest key, plus one for the end of a range
+    max_key = (dictionary.nan_code + 1) * (sample_size + 1) ** 2
+    return np.uint32 if max_key <= np.iinfo(np.uint32).max else np.uint64
+
+
+# Row ids fit in uint32 up to n = 76; the dataset has C(n + 7, 7) rows
+def get_index_id_dtype(sample_size: int):
+    return np.uint32 if math.comb(sample_size + 7, 7) <= np.iinfo(np.uint32).max else np.uint64
+
+
+def get_index_keys(codes, gr_key, ir_key, sample_size: int):
+    return (codes.astype(np.int64) * (sample_size + 1) + gr_key) * (sample_size + 1) + ir_key
+
+
+# Merges the sorted runs in blocks of about `chunk_rows` rows: the keys of the blocks are bounded by splitters,
+# sampled from every run, so each block is a slice of each run, found by binary search, sorted by key.
+# A class rather than a closure, as histogram_cube._CubeCounter.
+class _RunMerger:
+    def __init__(self, manifest, metric: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, stats=None):
+        self.manifest = manifest
+        self.chunk_rows = chunk_rows
+        self.stats = stats
+        self.inputs = [f'{metric}.index.runs.keys.bin', f'{metric}.index.runs.ids.bin']
+
+    # [start, stop) of the sorted runs, in one chunked pass over the keys
+    def _get_runs(self):
+        bounds, rows, last = [0], 0, None
+        for chunk in self.manifest.read_chunks(self.inputs[0], stats=self.stats):
+            if len(chunk) and last is not None and chunk[0] < last:
+                bounds.append(rows)
+            bounds.extend(np.flatnonzero(chunk[1:] < chunk[:-1]) + 1 + rows)
+            rows, last = rows + len(chunk), chunk[-1] if len(chunk) else last
+        return list(zip(bounds, bounds[1:] + [rows]))
+
+    def __call__(self):
+        keys, ids = (self.manifest.view(fn) for fn in self.inputs)
+        runs = self._get_runs()
+
+        # every `step`-th key of every run stands for `step` rows
+        step = max(self.chunk_rows // 16, 1)
+        sample = np.sort(np.concatenate([keys[start:stop:step] for start, stop in runs]))
+        splitters = np.unique(sample[16::16])
+
+        starts = [start for start, _ in runs]
+        for splitter in [*splitters, None]:
+            stops = [
+                stop if splitter is None else start + int(np.searchsorted(keys[start:stop], splitter))
+                for start, (_, stop) in zip(starts, runs)
+            ]
+            block_keys = np.concatenate([keys[start:stop] for start, stop in zip(starts, stops)])
+            block_ids = np.concatenate([ids[start:stop] for start, stop in zip(starts, stops)])
+            # stable: the runs are in the order of the rows, so are the ids of each key
+            order = np.argsort(block_keys, kind='stable')
+            yield block_keys.take(order), block_ids.take(order)
+
+            for start, stop in zip(starts, stops):
+                release_pages(keys, slice(start, stop))
+                release_pages(ids, slice(start, stop))
+            starts = stops
+
+
+# The sorted index of a difference metric, merged from its runs, unless it is up to date in the manifest
+def save_value_index(manifest, metric: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, stats=None):
+    merge = _RunMerger(manifest, metric, chunk_rows, stats)
+    return manifest.save_streamed([f'{metric}.index.keys.bin', f'{metric}.index.ids.bin'], merge, merge.inputs, stats)
+
+
+class ValueIndex:
+    def __init__(self, manifest, metric: str, sample_size: int):
+        self.metric = metric
+        self.sample_size = sample_size
+        self.dictionary = DiffDictionary(sample_size)
+
+        # mapped, not loaded: a lookup only reads the pages it needs
+        self.keys = manifest.view(f'{metric}.index.keys.bin')
+        self.ids = manifest.view(f'{metric}.index.ids.bin')
+
+    def _get_key(self, ratio):
+        key = round(ratio * self.sample_size)
+        is_stratum = 0 <= key <= self.sample_size and np.isclose(key, ratio * self.sample_size)
+        assert is_stratum, f'No stratum with ratio {ratio}'
+        return key
+
+    # codes of the value (None for NaN), or of all values within `epsilon` of it
+    def _get_codes(self, value, epsilon=None):
+        if value is None or np.isnan(value):
+            return np.array([self.dictionary.nan_code])
+        if epsilon is not None:
+            return np.flatnonzero(np.abs(self.dictionary.values - value) < epsilon)
+
+        code = self.dictionary.code_of(value)
+        return np.array([] if code is None else [code], dtype=np.int64)
+
+    # [start, stop) ranges of the keys of the codes, within the given GR and IR (all of them if None)
+    def _get_key_ranges(self, codes, gr, ir):
+        n_keys = self.sample_size + 1
+        if gr is None and ir is None:
+            starts = codes * n_keys * n_keys
+            return starts, starts + n_keys * n_keys
+
+        grs = np.arange(n_keys) if gr is None else np.array([self._get_key(gr)])
+        starts = ((codes[:, np.newaxis] * n_keys + grs[np.newaxis, :]) * n_keys).ravel()
+        if ir is None:
+            return starts, starts + n_keys
+        starts = starts + self._get_key(ir)
+        return starts, starts + 1
+
+    # Ids of the rows (sorted) with the given value of the metric (None for NaN) in the given GR and IR,
+    # e.g. `get_rows(0, gr=1/28)`; with `epsilon`, the rows with values within epsilon of it
+    def get_rows(self, value, gr=None, ir=None, epsilon=None):
+        starts, stops = self._get_key_ranges(self._get_codes(value, epsilon), gr, ir)
+        starts = np.searchsorted(self.keys, starts.astype(self.keys.dtype))
+        lengths = np.searchsorted(self.keys, stops.astype(self.keys.dtype)) - starts
+        # positions of the rows of all the ranges
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.sort(self.ids[positions])
+
+
+# Rows of the dataset with the given ids, e.g. from `ValueIndex.get_rows`, as a data frame indexed by the ids,
+# computed from the ids (see sets_creation.unrank_k)
+def get_dataset_rows(ids, sample_size: int):
+    return pd.DataFrame(unrank_k(8, sample_size, ids), columns=data_cols, index=ids)
@@ -0,0 +1,156 @@
+__all__ = [
+    'ZONE_ROWS',
+    'get_zone_map_file',
+    'get_zone_columns',
+    'save_zone_maps',
+    'Query',
+]
+
+import operator
+
+import numpy as np
+
+from chunked_io import DEFAULT_CHUNK_ROWS
+
+# rows of a zone: the smaller the zones, the more of them a selective query skips
+ZONE_ROWS = 1 << 16
+
+# comparisons of the predicates, and whether a zone with the given min, max and NaN count may have a matching row
+# (NaN compares False, except with !=)
+_operators = {
+    '<': (operator.lt, lambda low, high, nans, value: low < value),
+    '<=': (operator.le, lambda low, high, nans, value: low <= value),
+    '>': (operator.gt, lambda low, high, nans, value: high > value),
+    '>=': (operator.ge, lambda low, high, nans, value: high >= value),
+    '==': (operator.eq, lambda low, high, nans, value: (low <= value) & (value <= high)),
+    '!=': (operator.ne, lambda low, high, nans, value: (nans > 0) | (low != value) | (high != value)),
+}
+
+
+# Zone map of a column: the min and max of the defined values, and the number of NaNs, of every ZONE_ROWS rows
+# (min = inf and max = -inf for zones without defined values), saved as a zones x 3 float64 table
+def get_zone_map_file(column: str):
+    return f'{column.removesuffix(".bin")}.zones.bin'
+
+
+# columns of the current dataset with a value for every row, except those of the value index
+# (files left from another dataset, e.g. before switching to the virtual one, are left out)
+def get_zone_columns(manifest):
+    rows = manifest.check('gr.bin')['rows']
+    return [
+        fn
+        for fn, entry in manifest.content['files'].items()
+        if entry['dataset_hash'] == manifest.dataset_hash
+        and entry['rows'] == rows
+        and '.index.' not in fn
+        and not fn.endswith('.zones.bin')
+    ]
+
+
+def _get_zones(values, zone_rows: int):
+    n_zones = -(-len(values) // zone_rows)
+    zones = np.full(n_zones * zone_rows, np.nan)
+    zones[: len(values)] = values
+    zones = zones.reshape(n_zones, zone_rows)
+
+    nan = np.isnan(zones)
+    nans = nan.sum(axis=1)
+    nans[-1] -= len(zones.ravel()) - len(values)  # padding of the last zone
+    low = np.where(nan, np.inf, zones).min(axis=1)
+    high = np.where(nan, -np.inf, zones).max(axis=1)
+    return np.stack([low, high, nans], axis=1)
+
+
+# Computes the zone map in one streaming pass over the column.
+# A class rather than a closure, as histogram_cube._CubeCounter.
+class _ZoneMapper:
+    def __init__(self, manifest, column: str, zone_rows: int = ZONE_ROWS, stats=None):
+        self.manifest = manifest
+        self.column = column
+        self.zone_rows = zone_rows
+        self.stats = stats
+
+    def __call__(self):
+        # chunks of whole zones
+        chunk_rows = self.zone_rows * max(DEFAULT_CHUNK_ROWS // self.zone_rows, 1)
+        chunks = self.manifest.read_chunks(self.column, chunk_rows, self.stats)
+        return np.concatenate([_get_zones(chunk, self.zone_rows) for chunk in chunks]).ravel()
+
+
+# The zone maps of the columns, unless they are up to date in the manifest
+def save_zone_maps(manifest, columns, zone_rows: int = ZONE_ROWS, stats=None):
+    for column in columns:
+        manifest.save(get_zone_map_file(column), _ZoneMapper(manifest, column, zone_rows, stats), [column])
+
+
+# Query over the columns of the manifest, with predicates such as [('gr', '>=', 0.2), ('accuracy', '>', 0.9),
+# ('equal_opp_diff', '<', 0)], all of which the rows have to match. Zones whose zone maps show that they have
+# no matching rows are skipped, and the others are read (from memory maps of the columns) and filtered chunk by chunk.
+# `zones_read` of `zones` is the part of the data read by the last query.
+class Query:
+    def __init__(self, manifest, predicates, zone_rows: int = ZONE_ROWS):
+        self.manifest = manifest
+        self.predicates = [(column.removesuffix('.bin'), op, value) for column, op, value in predicates]
+        self.zone_rows = zone_rows
+        # all the columns have a value for every row (see get_zone_columns); without predicates, every row matches
+        self.rows = manifest.check('gr.bin')['rows']
+        self.zones = -(-self.rows // zone_rows)
+        self.zones_read = 0
+
+    # zones that may have matching rows
+    def _get_candidate_zones(self):
+        candidates = np.ones(self.zones, dtype=bool)
+        for column, op, value in self.predicates:
+            low, high, nans = self.manifest.load(get_zone_map_file(column)).reshape(-1, 3).T
+            candidates &= _operators[op][1](low, high, nans, value)
+        return np.flatnonzero(candidates)
+
+    # (first row, mask of the matching rows, values of the `columns`) of the runs of candidate zones,
+    # in pieces of at most DEFAULT_CHUNK_ROWS rows
+    def _scan(self, columns=()):
+        zones = self._get_candidate_zones()
+        self.zones_read = len(zones)
+        views = {column: self.manifest.view(column) for column in [*columns, *(c for c, _, _ in self.predicates)]}
+
+        # runs of consecutive zones
+        run_starts = np.flatnonzero(np.diff(zones, prepend=-np.inf) > 1)
+        run_ends = np.flatnonzero(np.diff(zones, append=np.inf) > 1)
+        for first, last in zip(zones[run_starts], zones[run_ends]):
+            stop = min((last + 1) * self.zone_rows, self.rows)
+            for start in range(first * self.zone_rows, stop, DEFAULT_CHUNK_ROWS):
+                rows = slice(start, min(start + DEFAULT_CHUNK_ROWS, stop))
+                values = {column: np.asarray(view[rows]) for column, view in views.items()}
+                mask = np.ones(rows.stop - rows.start, dtype=bool)
+                for column, op, value in self.predicates:
+                    mask &= _operators[op][0](values[column], value)
+                yield start, mask, values
+
+    def count(self):
+        return sum(int(mask.sum()) for _, mask, _ in self._scan())
+
+    # ids (positions in the dataset) of the matching rows
+    def row_ids(self):
+        ids = [start + np.flatnonzero(mask) for start, mask, _ in self._scan()]
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.intp)
+
+    # number of matching rows, NaNs among their values of the column, and the sum, min, max and mean of the others
+    def aggregate(self, column: str):
+        column = column.removesuffix('.bin')
+        count, nans, total, low, high = 0, 0, 0.0, np.inf, -np.inf
+        for _, mask, chunks in self._scan([column]):
+            values = chunks[column][mask].astype(np.float64)
+            defined = values[~np.isnan(values)]
+            count += len(values)
+            nans += len(values) - len(defined)
+            if len(defined):
+                total += defined.sum()
+                low, high = min(low, defined.min()), max(high, defined.max())
+        n = count - nans
+        return {
+            'count': count,
+            'nan': nans,
+            'sum': total,
+            'min': low if n else np.nan,
+            'max': high if n else np.nan,
+            'mean': total / n if n else np.nan,
+        }